@@ -38,9 +38,17 @@ class LabelResult with _$LabelResult {
 
 /// Must call [start] first, and [shutdown] at the end.
 class Labeler {
-  Labeler({IOSink? out}) : _out = out ?? stdout;
+  Labeler({IOSink? out, this.sessionId = '', this.filterOnServer = false})
+      : _out = out ?? stdout;
   final IOSink _out;
 
+  /// Labelers sharing a server need different ids to keep their plots apart.
+  final String sessionId;
+
+  /// Let the server filter and merge lines and send them packed, instead of
+  /// receiving every LSD segment.
+  final bool filterOnServer;
+
   Future<void> start() async {
     _lineServer = ServerProcess('line_detector_server', out: _out);
     await _lineServer!.start();
@@ -79,13 +87,13 @@ class Labeler {
       return;
     }
     _lastFilter!.adjustRightBottomX(indexDelta);
-    await _lineClient.resetPlot(pb.Empty());
+    await _lineClient.resetPlot(_session);
     await _plot(_lastFilter!, _lastClosest);
   }
 
   Future<void> resetImage() async {
-    await _lineClient.resetPlot(pb.Empty());
-    await _lineClient.exportPng(pb.Empty());
+    await _lineClient.resetPlot(_session);
+    await _lineClient.exportPng(_session);
     _out.writeln('Image reset.');
   }
 
@@ -95,6 +103,30 @@ class Labeler {
         videoPath: videoPath, frameIndex: frameIndex, modelPath: modelPath));
   }
 
+  /// Detect frames in [beginIndex, endIndex) with one streaming request. The
+  /// server decodes sequentially and doesn't plot. Pass [lsd] to only search
+  /// below the horizon, on a downscaled frame, or without short segments.
+  Stream<pb.LineDetection> detectVideoRange(
+      String videoPath, int beginIndex, int endIndex,
+      {pb.LsdOptions? lsd}) {
+    return _lineClient.detectVideoRange(pb.VideoRangeRequest(
+        videoPath: videoPath,
+        beginFrame: beginIndex,
+        endFrame: endIndex,
+        lsd: lsd));
+  }
+
+  /// Wait up to [timeoutSeconds] for the line detector's models to load. The
+  /// server accepts requests right away, but those needing obstacles block
+  /// until DETR is loaded.
+  Future<pb.HealthStatus> waitLineDetectorReady({double timeoutSeconds = 60}) =>
+      _lineClient
+          .waitReady(pb.WaitReadyRequest(timeoutSeconds: timeoutSeconds));
+
+  /// Stage latencies, counters and gauges of the line detector server.
+  Future<pb.ServerStats> lineDetectorStats() =>
+      _lineClient.getStats(pb.Empty());
+
   Future<LabelResult?> labelVideoWithSam(
       String videoPath, int frameIndex, String? modelPath) async {
     if (_segmentServer == null) {
@@ -120,6 +152,22 @@ class Labeler {
     return await labelAfterMask(maskLabel, label);
   }
 
+  /// Segment the road in frames [beginIndex, endIndex) with SAM. Each mask is
+  /// propagated from the previous frame's and written to [outputPath] as run
+  /// lengths, one JSON line per frame.
+  Stream<pb.SegmentResult> segmentVideoRange(
+      String videoPath, int beginIndex, int endIndex,
+      {String outputPath = ''}) async* {
+    if (_segmentServer == null) {
+      await _startSegmentServer();
+    }
+    yield* _segmentClient.segmentVideoRange(pb.SegmentRangeRequest(
+        videoPath: videoPath,
+        beginFrame: beginIndex,
+        endFrame: endIndex,
+        outputPath: outputPath));
+  }
+
   Future<LabelResult?> labelImage(String imagePath, String? modelPath) async {
     LabelResult? result;
     _out.writeln('Labeling image: $imagePath');
@@ -157,16 +205,28 @@ class Labeler {
     return null;
   }
 
+  /// Maps comma10k mask colors that aren't obstacles to road.
+  static List<pb.ColorMapping> commaColorMappings() => <pb.ColorMapping>[
+        // comma10k my car to road
+        pb.ColorMapping(fromHex: '#cc00ff', toHex: '#402020'),
+        // comma10k movable to road
+        pb.ColorMapping(fromHex: '#00ff66', toHex: '#402020'),
+        // comma10k movable_in_my_car to road
+        pb.ColorMapping(fromHex: '#00ccff', toHex: '#402020'),
+      ];
+
+  /// Detect many images (e.g., comma10k masks with [commaColorMappings]) with
+  /// one streaming request. The server reads ahead and doesn't plot.
+  Stream<pb.LineDetection> detectImages(List<String> imagePaths,
+      {List<pb.ColorMapping> colorMappings = const [], pb.LsdOptions? lsd}) {
+    return _lineClient.detectImages(pb.ImageBatchRequest(
+        imagePaths: imagePaths, colorMappings: colorMappings, lsd: lsd));
+  }
+
   Future<LineFilter> labelCommaMask(String maskPath, {bool plot = true}) async {
-    final map = <pb.ColorMapping>[
-      // comma10k my car to road
-      pb.ColorMapping(fromHex: '#cc00ff', toHex: '#402020'),
-      // comma10k movable to road
-      pb.ColorMapping(fromHex: '#00ff66', toHex: '#402020'),
-      // comma10k movable_in_my_car to road
-      pb.ColorMapping(fromHex: '#00ccff', toHex: '#402020'),
-    ];
-    final request = pb.LineRequest(imagePath: maskPath, colorMappings: map);
+    final map = commaColorMappings();
+    final request = pb.LineRequest(
+        imagePath: maskPath, colorMappings: map, headless: !plot);
     final LineFilter filter = await _handleRequest(request, plot: false);
 
     // Try to refresh right bottom x without lane markings (i.e., maps comma10k
@@ -178,7 +238,8 @@ class Labeler {
     filter.refreshRightBottomX(newDetection);
     const kNewDetectionProtoDump = '/tmp/new_line_detection.pb';
     File(kNewDetectionProtoDump).writeAsBytesSync(newDetection.writeToBuffer());
-    _out.writeln('Detection w/o landmarks: ${newDetection.lines.length} lines');
+    final int newLines = LineFilter.linesOf(newDetection).length;
+    _out.writeln('Detection w/o landmarks: $newLines lines');
     _out.writeln('New detection proto saved to $kNewDetectionProtoDump');
     _out.writeln('Updated right bottom x: ${filter.rightBottomX}');
 
@@ -195,7 +256,8 @@ class Labeler {
     bool plot = true,
   }) async {
     _lastFilter = await _handleRequest(
-      pb.LineRequest(imagePath: imagePath, modelPath: modelPath),
+      pb.LineRequest(
+          imagePath: imagePath, modelPath: modelPath, headless: !plot),
       plot: plot,
     );
     return _lastFilter!;
@@ -233,6 +295,9 @@ class Labeler {
     final stopwatch = Stopwatch()..start();
     _out.writeln('Sending request...');
     late pb.LineDetection detection;
+    request.sessionId = sessionId;
+    request.filterLines = filterOnServer;
+    request.packLines = filterOnServer;
     try {
       detection = await _lineClient.detectLines(request);
     } catch (e) {
@@ -250,7 +315,8 @@ class Labeler {
             request.imagePath.contains('segment'));
     final String dumpPath = isMask ? kMaskDetectionDump : kDetectionProtoDump;
     File(dumpPath).writeAsBytesSync(detection.writeToBuffer());
-    _out.writeln('Detection: ${detection.lines.length} lines detected ($size)');
+    final int lines = LineFilter.linesOf(detection).length;
+    _out.writeln('Detection: $lines lines detected ($size)');
     _out.writeln('Received detection in ${stopwatch.elapsedMilliseconds}ms');
     _out.writeln('Detected ${obstacles.length} obstacles');
     if (obstacles.isNotEmpty) {
@@ -286,19 +352,19 @@ class Labeler {
 
   Future<void> _plot(LineFilter filter, pb.Obstacle? closestObstacle) async {
     final stopwatch = Stopwatch()..start();
-    await _lineClient.plot(pb.PlotRequest(
+    await _plotRequest(pb.PlotRequest(
       points: filter.intersections.map((v) => vec2Proto(v)),
       pointColor: 'blue',
       lines: _computeBoundaries(filter),
       lineColor: 'blue',
     ));
-    await _lineClient.plot(pb.PlotRequest(
+    await _plotRequest(pb.PlotRequest(
         lines: filter.rightLines.map((l) => l.pbLine), lineColor: 'yellow'));
-    await _lineClient.plot(pb.PlotRequest(
+    await _plotRequest(pb.PlotRequest(
         lines: filter.leftLines.map((l) => l.pbLine), lineColor: 'green'));
     if (filter.guessedPoint != null) {
       _out.writeln('Guessed point: ${filter.guessedPoint}');
-      await _lineClient.plot(pb.PlotRequest(
+      await _plotRequest(pb.PlotRequest(
         points: [vec2Proto(filter.guessedPoint!)],
         pointColor: 'red',
       ));
@@ -313,14 +379,20 @@ class Labeler {
       final double x0 = width * obs.l;
       final double x1 = width * obs.r;
       _out.writeln('Closest obstacle: ${obs.label} at b=${obs.b}, w=$w');
-      await _lineClient.plot(pb.PlotRequest(
+      await _plotRequest(pb.PlotRequest(
           lines: [pb.Line(x0: x0, y0: y, x1: x1, y1: y)], lineColor: 'red'));
     }
 
-    await _lineClient.exportPng(pb.Empty());
+    await _lineClient.exportPng(_session);
     _out.writeln('Plotted in ${stopwatch.elapsedMilliseconds}ms\n');
   }
 
+  pb.SessionRequest get _session => pb.SessionRequest(sessionId: sessionId);
+
+  Future<void> _plotRequest(pb.PlotRequest request) async {
+    await _lineClient.plot(request..sessionId = sessionId);
+  }
+
   List<pb.Line> _computeBoundaries(LineFilter filter) {
     final pb.LineDetection detection = filter.detection!;
     final List<pb.Line> boundaries = [];
@@ -1,5 +1,6 @@
 import 'dart:io';
 import 'dart:math';
+import 'dart:typed_data';
 
 import 'package:roadart/proto/label.pb.dart' as pb;
 import 'package:vector_math/vector_math_64.dart';
@@ -80,6 +81,21 @@ class LineFilter {
 
   String debugImagePath = ''; // image path, or video path and frame index.
 
+  /// The detected lines, whether sent as messages or packed float32s.
+  static List<pb.Line> linesOf(pb.LineDetection detection) {
+    if (detection.packedLines.isEmpty) return detection.lines;
+    final data =
+        ByteData.sublistView(Uint8List.fromList(detection.packedLines));
+    return [
+      for (int i = 0; i + 16 <= data.lengthInBytes; i += 16)
+        pb.Line(
+            x0: data.getFloat32(i, Endian.little),
+            y0: data.getFloat32(i + 4, Endian.little),
+            x1: data.getFloat32(i + 8, Endian.little),
+            y1: data.getFloat32(i + 12, Endian.little)),
+    ];
+  }
+
   void process(pb.LineDetection detection) {
     _detection = detection;
     if (kSaveProto) {
@@ -87,17 +103,25 @@ class LineFilter {
       print('Saved proto to $kSaveFile');
     }
 
-    for (final pbLine in detection.lines) {
-      final line = Line(pbLine, detection);
-      if (_rightConditions.accepts(line)) {
-        _rightLines.add(line);
-      } else if (_leftConditions.accepts(line)) {
-        _leftLines.add(line);
+    final List<pb.Line> lines = linesOf(detection);
+    if (detection.filtered) {
+      // The server already filtered and merged them (see line_filter.py).
+      final int n = detection.rightLineCount;
+      _rightLines = [for (final l in lines.take(n)) Line(l, detection)];
+      _leftLines = [for (final l in lines.skip(n)) Line(l, detection)];
+    } else {
+      for (final pbLine in lines) {
+        final line = Line(pbLine, detection);
+        if (_rightConditions.accepts(line)) {
+          _rightLines.add(line);
+        } else if (_leftConditions.accepts(line)) {
+          _leftLines.add(line);
+        }
       }
+      final merger = LineMerger(detection.width, detection.height);
+      _leftLines = merger.merge(_leftLines);
+      _rightLines = merger.merge(_rightLines);
     }
-    final merger = LineMerger(detection.width, detection.height);
-    _leftLines = merger.merge(_leftLines);
-    _rightLines = merger.merge(_rightLines);
 
     final xBounds = Range(0, detection.width.toDouble());
     final yBounds = Range(0, detection.height.toDouble());
@@ -126,14 +150,22 @@ class LineFilter {
   void refreshRightBottomX(pb.LineDetection newDetection) {
     _rightBottomX = null;
     _rightLines.clear();
-    for (final pbLine in newDetection.lines) {
-      final line = Line(pbLine, newDetection);
-      if (_rightConditions.accepts(line)) {
-        _rightLines.add(line);
+    final List<pb.Line> lines = linesOf(newDetection);
+    if (newDetection.filtered) {
+      _rightLines = [
+        for (final l in lines.take(newDetection.rightLineCount))
+          Line(l, newDetection)
+      ];
+    } else {
+      for (final pbLine in lines) {
+        final line = Line(pbLine, newDetection);
+        if (_rightConditions.accepts(line)) {
+          _rightLines.add(line);
+        }
       }
+      _rightLines = LineMerger(newDetection.width, newDetection.height)
+          .merge(_rightLines);
     }
-    _rightLines =
-        LineMerger(newDetection.width, newDetection.height).merge(_rightLines);
     _computeRightBottomX(newDetection);
   }
 
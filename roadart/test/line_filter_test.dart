@@ -1,9 +1,23 @@
+import 'dart:convert';
 import 'dart:io';
+import 'dart:typed_data';
 
 import 'package:roadart/proto/label.pb.dart' as pb;
 import 'package:roadart/src/line_filter.dart';
+import 'package:roadart/src/line_merger.dart';
 import 'package:test/test.dart';
 
+void _expectLines(List<Line> lines, List<dynamic> expected, String reason) {
+  expect(lines.length, expected.length, reason: reason);
+  for (int i = 0; i < lines.length; ++i) {
+    final l = lines[i];
+    final values = [l.start.x, l.start.y, l.end.x, l.end.y];
+    for (int j = 0; j < 4; ++j) {
+      expect(values[j], closeTo(expected[i][j], 1e-6), reason: reason);
+    }
+  }
+}
+
 void main() {
   test('LineFilter finds curb boundaries', () {
     final filter = LineFilter();
@@ -22,6 +36,51 @@ void main() {
     expect(filter.rightLines, isEmpty);
   });
 
+  // roadpy/check_line_filter.py checks server/line_filter.py against the same
+  // golden, so the two filters can't drift apart.
+  test('LineFilter matches the golden shared with roadpy', () {
+    final golden = jsonDecode(
+        File('test/data/line_filter_golden.json').readAsStringSync());
+    for (final c in golden['cases']) {
+      final pb.LineDetection detection;
+      if (c.containsKey('detection')) {
+        detection = pb.LineDetection.fromBuffer(
+            File('test/data/${c['detection']}').readAsBytesSync());
+      } else {
+        detection = pb.LineDetection(width: c['width'], height: c['height']);
+        for (final l in c['lines']) {
+          detection.lines.add(pb.Line(
+              x0: l[0].toDouble(),
+              y0: l[1].toDouble(),
+              x1: l[2].toDouble(),
+              y1: l[3].toDouble()));
+        }
+      }
+      final filter = LineFilter()..process(detection);
+      _expectLines(filter.rightLines, c['right'], '${c['name']} right');
+      _expectLines(filter.leftLines, c['left'], '${c['name']} left');
+    }
+  });
+
+  test('LineFilter takes lines filtered and packed by the server', () {
+    const values = [700.0, 400.0, 900.0, 700.0, 300.0, 700.0, 500.0, 400.0];
+    final data = ByteData(values.length * 4);
+    for (int i = 0; i < values.length; ++i) {
+      data.setFloat32(i * 4, values[i], Endian.little);
+    }
+    final lineDetection = pb.LineDetection(
+        width: 1280,
+        height: 720,
+        filtered: true,
+        rightLineCount: 1,
+        packedLines: data.buffer.asUint8List());
+    final filter = LineFilter()..process(lineDetection);
+    expect(filter.rightLines.length, 1);
+    expect(filter.rightLines.first.end.x, 900.0);
+    expect(filter.leftLines.length, 1);
+    expect(filter.leftLines.first.start.x, 300.0);
+  });
+
   test('LineFilter discards intersection with false left vanishing point', () {
     final filter = LineFilter();
     final lineDetection = pb.LineDetection.fromBuffer(
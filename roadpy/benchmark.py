@@ -0,0 +1,341 @@
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import click
+import cv2
+import numpy as np
+
+from make_tfrecord import LABEL_KEYS, make_tasks, process_label_result
+from tfrecord_utils import draw_prediction, resize_image
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+os.environ["KERAS_BACKEND"] = "jax"
+
+BASELINE_PATH = "ignore/benchmark_baseline.json"
+STAGES = [
+    "resize_image",
+    "read_video_sequential",
+    "read_video_random",
+    "obstacle_detect",
+    "detect_bgr_miss",
+    "detect_bgr_hit",
+    "lsd_full",
+    "lsd_roi",
+    "filter_lines",
+    "draw_prediction",
+    "process_label_result",
+    "train_input",
+]
+
+
+def synthetic_frame(i: int, width: int, height: int, rng) -> np.ndarray:
+    """A road-like frame: sky, road, a swaying lane line and a moving box."""
+    frame = np.empty((height, width, 3), np.uint8)
+    frame[: height // 2] = (200, 160, 120)
+    frame[height // 2 :] = (90, 90, 90)
+    x = width // 2 + int(width * 0.3 * np.sin(i / 10))
+    cv2.line(frame, (width // 2, height // 2), (x, height), (255, 255, 255), 8)
+    left = (i * 7) % width
+    top = height // 2 + height // 8
+    cv2.rectangle(frame, (left, top), (left + 80, top + 60), (0, 0, 255), -1)
+    # Noise keeps the codec honest; flat frames decode unrealistically fast.
+    return cv2.add(frame, rng.integers(0, 16, frame.shape, dtype=np.uint8))
+
+
+def make_video(path: str, frames: int, width: int, height: int):
+    rng = np.random.default_rng(0)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 30, (width, height))
+    for i in range(frames):
+        writer.write(synthetic_frame(i, width, height, rng))
+    writer.release()
+
+
+def make_label_json(json_path: str, video_path: str, frames: int):
+    """Write a label_result.json with random labels for every frame."""
+    rng = random.Random(0)
+    label_result = {}
+    for i in range(frames):
+        image_path = f"{video_path}:{i}"
+        json_map = {k: rng.random() for k in LABEL_KEYS}
+        json_map["imagePath"] = image_path
+        label_result[image_path] = json_map
+    with open(json_path, "w") as f:
+        json.dump(label_result, f)
+
+
+def make_obstacle_detector():
+    """An ObstacleDetector with a small, randomly initialized DETR."""
+    import torch
+    from transformers import (
+        DetrConfig,
+        DetrForObjectDetection,
+        DetrImageProcessor,
+        ResNetConfig,
+    )
+
+    from server.obstacle import ObstacleDetector
+
+    torch.manual_seed(0)
+    backbone_config = ResNetConfig(
+        embedding_size=32,
+        hidden_sizes=[32, 64, 128, 256],
+        depths=[1, 1, 1, 1],
+        layer_type="basic",
+        out_features=["stage4"],
+    )
+    config = DetrConfig(
+        use_timm_backbone=False,
+        use_pretrained_backbone=False,
+        backbone=None,
+        backbone_config=backbone_config,
+        num_queries=20,
+        d_model=64,
+        encoder_layers=1,
+        decoder_layers=1,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=128,
+        decoder_ffn_dim=128,
+        id2label={i: f"class_{i}" for i in range(8)},
+    )
+    return ObstacleDetector(
+        processor=DetrImageProcessor(), model=DetrForObjectDetection(config)
+    )
+
+
+def measure(fn: Callable, inputs: List, items: int = 1, warm_up: int = 2) -> dict:
+    """Time fn on each input. Returns latency percentiles and items/sec."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        for x in inputs[:warm_up]:
+            fn(x)
+        seconds = []
+        for x in inputs:
+            start = time.perf_counter()
+            fn(x)
+            seconds.append(time.perf_counter() - start)
+    ms = np.array(seconds) * 1000
+    p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+    return {
+        "p50_ms": float(p50),
+        "p90_ms": float(p90),
+        "p99_ms": float(p99),
+        "throughput": len(inputs) * items / sum(seconds),
+        "calls": len(inputs),
+    }
+
+
+def run_stages(stages, tmp: Path, frames: int, shard_size: int, batch_size: int):
+    from server.line_detector_server import LineDetector, LsdOptions, detect_segments
+    from server.result_cache import ResultCache
+    from server.server_utils import read_video_bgr
+
+    video_path = str(tmp / "synthetic.mp4")
+    json_path = str(tmp / "label_result.json")
+    indices = list(range(frames))
+    bgrs = [read_video_bgr(video_path, i) for i in indices]
+    results = {}
+
+    if "resize_image" in stages:
+        results["resize_image"] = measure(resize_image, bgrs)
+    if "read_video_sequential" in stages:
+        results["read_video_sequential"] = measure(
+            lambda i: read_video_bgr(video_path, i), indices
+        )
+    if "read_video_random" in stages:
+        shuffled = random.Random(0).sample(indices, len(indices))
+        results["read_video_random"] = measure(
+            lambda i: read_video_bgr(video_path, i), shuffled
+        )
+
+    detect_stages = {"obstacle_detect", "detect_bgr_miss", "detect_bgr_hit"}
+    if detect_stages & set(stages):
+        obstacle_detector = make_obstacle_detector()
+        rgbs = [cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB) for bgr in bgrs]
+        if "obstacle_detect" in stages:
+            results["obstacle_detect"] = measure(obstacle_detector.detect, rgbs)
+        detector = LineDetector(
+            obstacle_detector=obstacle_detector,
+            result_cache=ResultCache(tmp / "result_cache.sqlite"),
+        )
+        # Every synthetic frame differs, so the first pass always misses.
+        if "detect_bgr_miss" in stages:
+            results["detect_bgr_miss"] = measure(
+                lambda bgr: detector._detectBgr(bgr, None), bgrs, warm_up=0
+            )
+        if "detect_bgr_hit" in stages:
+            for bgr in bgrs:
+                detector._detectBgr(bgr, None)
+            results["detect_bgr_hit"] = measure(
+                lambda bgr: detector._detectBgr(bgr, None), bgrs
+            )
+
+    # LSD stages don't need DETR, so they run without a LineDetector.
+    lsd = cv2.createLineSegmentDetector()
+    if "lsd_full" in stages:
+        results["lsd_full"] = measure(
+            lambda bgr: detect_segments(lsd, bgr, LsdOptions()), bgrs
+        )
+    if "lsd_roi" in stages:
+        # The synthetic horizon is at half the height.
+        roi = LsdOptions(bgrs[0].shape[0] / 2, pyramid_level=1, min_length=16)
+        results["lsd_roi"] = measure(lambda bgr: detect_segments(lsd, bgr, roi), bgrs)
+    if "filter_lines" in stages:
+        from server.line_filter import filter_lines
+
+        height, width = bgrs[0].shape[:2]
+        segments = [detect_segments(lsd, bgr, LsdOptions()) for bgr in bgrs]
+        results["filter_lines"] = measure(
+            lambda lines: filter_lines(lines, width, height), segments
+        )
+
+    if "draw_prediction" in stages:
+        from inference import KerasBackend
+        from train import make_compiled_model
+
+        engine = KerasBackend(make_compiled_model())
+        results["draw_prediction"] = measure(
+            lambda bgr: draw_prediction(engine, bgr), bgrs
+        )
+
+    tfrecord_path = str(tmp / "synthetic.tfrecord")
+    if "process_label_result" in stages or "train_input" in stages:
+        with open(json_path) as f:
+            tasks = make_tasks(json.load(f), shard_size)
+        shards = list(enumerate(tasks))
+        # train_input reads the shards this writes.
+        encoded = measure(
+            lambda shard: process_label_result(tfrecord_path, shard[1], shard[0]),
+            shards,
+            items=shard_size,
+            warm_up=0,
+        )
+        if "process_label_result" in stages:
+            results["process_label_result"] = encoded
+
+    if "train_input" in stages:
+        from train import load_dataset_rgb_int8
+
+        pattern = tfrecord_path.replace(".tfrecord", "_*.tfrecord")
+        _, train_dataset = load_dataset_rgb_int8(pattern=pattern)
+        batches = train_dataset.batch(batch_size).repeat()
+        iterator = iter(batches)
+        steps = max(frames // batch_size, 1) * 4
+        results["train_input"] = measure(
+            lambda _: next(iterator), list(range(steps)), items=batch_size
+        )
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Return the stages whose p50 got slower than the baseline allows."""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        limit = baseline[name]["p50_ms"] * (1 + tolerance)
+        if result["p50_ms"] > limit:
+            regressions.append(
+                f"{name}: p50={result['p50_ms']:.2f}ms > {limit:.2f}ms "
+                f"(baseline {baseline[name]['p50_ms']:.2f}ms + {tolerance:.0%})"
+            )
+    return regressions
+
+
+@click.command()
+@click.option("--frames", type=int, default=128, help="Frames of the synthetic video")
+@click.option("--width", type=int, default=1280)
+@click.option("--height", type=int, default=720)
+@click.option("--shard_size", type=int, default=32, help="Labels per TFRecord shard")
+@click.option("--batch_size", type=int, default=32, help="train_input batch size")
+@click.option(
+    "--stage",
+    "stages",
+    type=click.Choice(STAGES),
+    multiple=True,
+    help="Stages to run (default: all)",
+)
+@click.option("--baseline", type=str, default=BASELINE_PATH)
+@click.option(
+    "--save_baseline", is_flag=True, help="Store these results as the new baseline"
+)
+@click.option(
+    "--tolerance", type=float, default=0.25, help="Allowed p50 slowdown (0.25=25%)"
+)
+def benchmark(
+    frames: int,
+    width: int,
+    height: int,
+    shard_size: int,
+    batch_size: int,
+    stages,
+    baseline: str,
+    save_baseline: bool,
+    tolerance: float,
+):
+    """
+    Benchmark the roadpy hot paths on generated fixtures, fully offline, and
+    compare the latencies with a baseline.
+
+    Example:
+    python benchmark.py --save_baseline   # on a known good commit
+    python benchmark.py                   # exits 1 on regressions or without a baseline
+    """
+    stages = stages or STAGES
+    config = {"frames": frames, "width": width, "height": height}
+    config.update(shard_size=shard_size, batch_size=batch_size)
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print(f"Generating {frames} synthetic {width}x{height} frames in {tmp}")
+        make_video(str(tmp / "synthetic.mp4"), frames, width, height)
+        make_label_json(
+            str(tmp / "label_result.json"), str(tmp / "synthetic.mp4"), frames
+        )
+        results = run_stages(stages, tmp, frames, shard_size, batch_size)
+
+    for name, r in results.items():
+        print(
+            f"{name:<24} p50={r['p50_ms']:9.2f}ms p90={r['p90_ms']:9.2f}ms "
+            f"p99={r['p99_ms']:9.2f}ms {r['throughput']:10.1f}/s"
+        )
+
+    if save_baseline:
+        os.makedirs(os.path.dirname(baseline) or ".", exist_ok=True)
+        saved = {"config": config, "stages": results}
+        if os.path.exists(baseline):
+            # Keep the stages that weren't rerun this time.
+            with open(baseline) as f:
+                old = json.load(f)
+            if old["config"] == config:
+                saved["stages"] = {**old["stages"], **results}
+        with open(baseline, "w") as f:
+            json.dump(saved, f, indent=2)
+        print(f"Saved baseline {baseline}")
+        return
+
+    if not os.path.exists(baseline):
+        # Without a baseline nothing is compared, which mustn't pass silently.
+        print(f"No baseline at {baseline}; run with --save_baseline first")
+        sys.exit(1)
+    with open(baseline) as f:
+        stored = json.load(f)
+    if stored["config"] != config:
+        print(f"Baseline config {stored['config']} differs from {config}")
+        sys.exit(1)
+    regressions = compare(results, stored["stages"], tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print(f"No regressions against {baseline}")
+
+
+if __name__ == "__main__":
+    benchmark()
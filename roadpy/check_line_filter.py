@@ -0,0 +1,59 @@
+import json
+import sys
+from pathlib import Path
+
+import click
+import numpy as np
+
+from proto import label_pb2
+from server.line_filter import filter_lines
+
+GOLDEN_PATH = Path(__file__).parent.parent / "roadart/test/data/line_filter_golden.json"
+
+
+def case_input(case: dict, data_dir: Path):
+    """(lines, width, height) of a golden case."""
+    if "detection" in case:
+        detection = label_pb2.LineDetection.FromString(
+            (data_dir / case["detection"]).read_bytes()
+        )
+        lines = [(line.x0, line.y0, line.x1, line.y1) for line in detection.lines]
+        return lines, detection.width, detection.height
+    return case["lines"], case["width"], case["height"]
+
+
+def compare(name: str, actual: np.ndarray, expected: list, tolerance: float):
+    """Return the mismatches between actual and expected lines."""
+    expected = np.array(expected, np.float64).reshape(-1, 4)
+    if actual.shape != expected.shape:
+        return [f"{name}: {len(actual)} lines, expected {len(expected)}"]
+    difference = np.abs(actual - expected).max(initial=0)
+    if difference > tolerance:
+        return [f"{name}: max abs difference {difference:.3g} > {tolerance}"]
+    return []
+
+
+@click.command()
+@click.option("--golden", type=str, default=str(GOLDEN_PATH))
+@click.option("--tolerance", type=float, default=1e-6, help="Max abs difference")
+def check_line_filter(golden: str, tolerance: float):
+    """
+    Check server/line_filter.py against the golden lines that roadart's
+    LineFilter is tested with (test/line_filter_test.dart), so the NumPy port
+    and the Dart filter can't drift apart.
+    """
+    golden = Path(golden)
+    failures = []
+    cases = json.loads(golden.read_text())["cases"]
+    for case in cases:
+        right, left = filter_lines(*case_input(case, golden.parent))
+        failures += compare(f"{case['name']} right", right, case["right"], tolerance)
+        failures += compare(f"{case['name']} left", left, case["left"], tolerance)
+    for failure in failures:
+        print(f"FAIL {failure}")
+    print(f"Checked {len(cases)} cases: {len(failures)} mismatches")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    check_line_filter()
@@ -0,0 +1,73 @@
+import os
+import glob
+import sys
+from typing import List
+import click
+import numpy as np
+
+from inference import KerasBackend, load_backend
+from tfrecord_utils import TFRECORD_PATH, split_dataset
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+import tensorflow as tf  # noqa: E402
+
+
+def load_test_images(tfrecord_path: str, count: int) -> List[np.ndarray]:
+    """Decode the first images of the test split as BGR uint8 arrays."""
+    raw_dataset = tf.data.TFRecordDataset(glob.glob(tfrecord_path))
+    test_set, _ = split_dataset(raw_dataset)
+    images = []
+    for raw_record in test_set.take(count):
+        example = tf.train.Example()
+        example.ParseFromString(raw_record[0].numpy())
+        image = example.features.feature["image"].bytes_list.value[0]
+        images.append(tf.image.decode_png(image, channels=3).numpy())
+    return images
+
+
+@click.command()
+@click.option("--tfrecord_path", type=str, default=TFRECORD_PATH)
+@click.option("--count", type=int, default=500, help="Test images to compare")
+@click.option("--batch_size", type=int, default=32)
+@click.option("--tolerance", type=float, default=1e-3, help="Max abs difference")
+@click.argument("keras_model")
+@click.argument("exported_models", nargs=-1, required=True)
+def check_parity(
+    tfrecord_path: str,
+    count: int,
+    batch_size: int,
+    tolerance: float,
+    keras_model: str,
+    exported_models,
+):
+    """
+    Compare exported models (.onnx, .tflite) with the keras model they came
+    from on the TFRecord test split.
+
+    Example:
+    python check_parity.py ignore/best_check.keras ignore/model.onnx ignore/model.tflite
+    """
+    images = load_test_images(tfrecord_path, count)
+    print(f"Comparing on {len(images)} test images")
+
+    def predict_all(backend):
+        batches = [
+            backend.predict_bgr(images[i : i + batch_size])
+            for i in range(0, len(images), batch_size)
+        ]
+        return np.concatenate(batches)
+
+    expected = predict_all(KerasBackend.load(keras_model))
+    failed = False
+    for path in exported_models:
+        diff = np.abs(predict_all(load_backend(path)) - expected)
+        print(f"{path}: max_diff={diff.max():.6f} mean_diff={diff.mean():.6f}")
+        if diff.max() > tolerance:
+            print(f"{path} differs from {keras_model} by more than {tolerance}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    check_parity()
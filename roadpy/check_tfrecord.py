@@ -1,20 +1,19 @@
 import os
-import glob
 import click
 import cv2
 
+from inference import load_backend
+from tfrecord_index import RecordReader
 from tfrecord_utils import (
     TFRECORD_PATH,
     draw_label,
     draw_prediction,
     resize_image,
-    split_dataset,
 )
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 os.environ["KERAS_BACKEND"] = "jax"
 
-import keras  # noqa: E402
 import tensorflow as tf  # noqa: E402
 
 
@@ -32,20 +31,21 @@ def check_tfrecord(
     Usage:
     python check_tfrecord.py <skip_count> <take_count>
 
-    - skip_count: The number of records to skip before starting to read.
+    - skip_count: The number of test records to skip before starting to read.
     - take_count: The number of records to read and display.
 
     Example:
     python check_tfrecord.py 0 10
     This will skip 0 records and display the first 10 records.
+
+    Records are read through the shard indices, so skipping is free.
     """
 
-    raw_dataset = tf.data.TFRecordDataset(glob.glob(tfrecord_path))
-    test_set, train_set = split_dataset(raw_dataset)
-    model = keras.models.load_model(model_file) if model_file else None
-    for raw_record in test_set.skip(skip_count).take(int(take_count)):
-        example = tf.train.Example()
-        example.ParseFromString(raw_record[0].numpy())
+    reader = RecordReader(tfrecord_path)
+    test_indices, _ = reader.split()
+    model = load_backend(model_file) if model_file else None
+    for i in test_indices[skip_count : skip_count + take_count]:
+        example = reader.example(i)
         image = example.features.feature["image"].bytes_list.value[0]
         label = example.features.feature["label"].float_list.value
         print(f"label={label}")
@@ -0,0 +1,134 @@
+import abc
+import math
+import os
+import threading
+from typing import List
+
+import numpy as np
+
+from tfrecord_utils import IMAGE_H, IMAGE_W, resize_image
+
+
+def to_input_batch(frames_bgr: List[np.ndarray]) -> np.ndarray:
+    """Resize BGR frames of any size into a uint8 RGB model input batch."""
+    batch = np.empty((len(frames_bgr), IMAGE_H, IMAGE_W, 3), dtype=np.uint8)
+    for i, bgr in enumerate(frames_bgr):
+        batch[i] = resize_image(bgr, IMAGE_W, IMAGE_H)[..., ::-1]
+    return batch
+
+
+class InferenceBackend(abc.ABC):
+    """Predicts raw labels from uint8 (N, IMAGE_H, IMAGE_W, 3) RGB batches."""
+
+    @abc.abstractmethod
+    def predict(self, inputs: np.ndarray) -> np.ndarray: ...
+
+    @abc.abstractmethod
+    def nbytes(self) -> int:
+        """Approximate memory held by the model."""
+
+    def predict_bgr(self, frames_bgr: List[np.ndarray]) -> np.ndarray:
+        return self.predict(to_input_batch(frames_bgr))
+
+    def warm_up(self):
+        """Run the single-frame shape once before the first real frame."""
+        self.predict(np.zeros((1, IMAGE_H, IMAGE_W, 3), dtype=np.uint8))
+
+
+class KerasBackend(InferenceBackend):
+    """Runs the forward pass of a keras model as a jitted JAX function.
+
+    Unlike model.predict, there's no dataset wrapping, callbacks or progress
+    printing per call. Batches are padded to a power of two so only a handful
+    of shapes are ever compiled.
+    """
+
+    def __init__(self, model):
+        import jax
+
+        self.model = model
+        self._trainable = [v.value for v in model.trainable_variables]
+        self._non_trainable = [v.value for v in model.non_trainable_variables]
+        self._forward = jax.jit(self._call)
+
+    @staticmethod
+    def load(path: str) -> "KerasBackend":
+        os.environ["KERAS_BACKEND"] = "jax"
+        import keras
+
+        return KerasBackend(keras.models.load_model(path))
+
+    def _call(self, trainable, non_trainable, x):
+        y, _ = self.model.stateless_call(trainable, non_trainable, x, training=False)
+        return y
+
+    def predict(self, inputs: np.ndarray) -> np.ndarray:
+        n = inputs.shape[0]
+        padded_n = 1 << max(n - 1, 0).bit_length()
+        if padded_n != n:
+            padding = np.zeros((padded_n - n,) + inputs.shape[1:], inputs.dtype)
+            inputs = np.concatenate([inputs, padding])
+        y = self._forward(self._trainable, self._non_trainable, inputs)
+        return np.asarray(y)[:n]
+
+    def nbytes(self) -> int:
+        return sum(
+            math.prod(w.shape) * np.dtype(w.dtype).itemsize for w in self.model.weights
+        )
+
+
+class OnnxBackend(InferenceBackend):
+    """CPU onnxruntime session for models exported by to_onnx.py."""
+
+    def __init__(self, path: str):
+        import onnxruntime
+
+        self._path = path
+        self._session = onnxruntime.InferenceSession(
+            path, providers=["CPUExecutionProvider"]
+        )
+        self._input_name = self._session.get_inputs()[0].name
+
+    def predict(self, inputs: np.ndarray) -> np.ndarray:
+        return self._session.run(None, {self._input_name: inputs})[0]
+
+    def nbytes(self) -> int:
+        return os.path.getsize(self._path)
+
+
+class TfliteBackend(InferenceBackend):
+    """TFLite interpreter for models exported by to_tflite.py."""
+
+    def __init__(self, path: str):
+        import tensorflow as tf
+
+        self._path = path
+        self._interpreter = tf.lite.Interpreter(model_path=path)
+        self._interpreter.allocate_tensors()
+        self._input = self._interpreter.get_input_details()[0]
+        self._output = self._interpreter.get_output_details()[0]
+        # The interpreter holds its tensors, so only one call can run at once.
+        self._lock = threading.Lock()
+
+    def predict(self, inputs: np.ndarray) -> np.ndarray:
+        with self._lock:
+            index = self._input["index"]
+            current = tuple(self._interpreter.get_input_details()[0]["shape"])
+            if current != inputs.shape:
+                self._interpreter.resize_tensor_input(index, inputs.shape)
+                self._interpreter.allocate_tensors()
+            self._interpreter.set_tensor(index, inputs.astype(self._input["dtype"]))
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output["index"]).copy()
+
+    def nbytes(self) -> int:
+        return os.path.getsize(self._path)
+
+
+def load_backend(model_path: str) -> InferenceBackend:
+    """Pick the backend by the model file extension."""
+    if model_path.endswith(".onnx"):
+        return OnnxBackend(model_path)
+    if model_path.endswith(".tflite"):
+        return TfliteBackend(model_path)
+    return KerasBackend.load(model_path)
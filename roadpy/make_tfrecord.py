@@ -1,11 +1,18 @@
 import os
 import click
 import cv2
+import glob
+import hashlib
 import json
-import tensorflow as tf
-import threading
+import multiprocessing
 import random
+from collections import defaultdict
+from concurrent import futures
+
+import tensorflow as tf
 
+from raw_dataset import RAW_DIR, create_raw, open_raw_for_write, save_paths
+from tfrecord_index import index_path, write_index
 from tfrecord_utils import (
     IMAGE_W,
     IMAGE_H,
@@ -16,101 +23,310 @@ from tfrecord_utils import (
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
+LABEL_KEYS = [
+    "xRatio",
+    "yRatio",
+    "leftRatio",
+    "rightRatio",
+    "yRatioObstacleMin",
+    "yRatioObstacleMax",
+    "xRatioObstacleMin",
+    "xRatioObstacleMax",
+    "obstacleConfidence",
+]
 
-def get_resized(image_path: str, width: int, height: int):
+SHARD_SIZE = 256  # Labels per shard (and per worker task)
+MAX_GRAB = 64  # Decode forward instead of seeking for gaps up to this many frames
+
+
+def parse_image_path(image_path: str):
+    """Return (video_path, frame_index), or (image_path, None) for images."""
     if image_path.endswith(".png") or image_path.endswith(".jpg"):
-        image = cv2.imread(image_path)
-    else:
-        split: int = image_path.rfind(":")
-        video_path = image_path[:split]
-        frame_index = int(image_path[split + 1 :])
-        cap = cv2.VideoCapture(video_path)
-        cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-        _, image = cap.read()
+        return image_path, None
+    split: int = image_path.rfind(":")
+    return image_path[:split], int(image_path[split + 1 :])
+
+
+def iter_images(json_maps):
+    """Yield (json_map, bgr) while decoding each video sequentially.
+
+    The json_maps of a video must be sorted by frame index. The bgr is None if
+    the image can't be read.
+    """
+    cap, cap_path, next_index = None, None, 0
+    for json_map in json_maps:
+        path, frame_index = parse_image_path(json_map["imagePath"])
+        if frame_index is None:
+            yield json_map, cv2.imread(path)
+            continue
+        if path != cap_path:
+            if cap:
+                cap.release()
+            cap, cap_path, next_index = cv2.VideoCapture(path), path, 0
+        gap = frame_index - next_index
+        if gap < 0 or gap > MAX_GRAB:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        else:
+            for _ in range(gap):
+                cap.grab()
+        ok, image = cap.read()
+        next_index = frame_index + 1
+        if not ok:
+            print(f"Failed to read {json_map['imagePath']}")
+        yield json_map, image if ok else None
+    if cap:
         cap.release()
-    return resize_image(image, width, height)
 
 
-def process_label_result(
-    tfrecord_path: str, result_list, start_index, end_index, thread_id: int
-):
-    writer = tf.io.TFRecordWriter(
-        tfrecord_path.replace(".tfrecord", f"_{thread_id}.tfrecord")
-    )
-    total: int = end_index - start_index
-    for i in range(start_index, end_index):
-        json_map = result_list[i]
-        if not json_map:
+def make_example(json_map, resized) -> bytes:
+    # The decoded png must have the BGR order of `resized`, but cv2 would store
+    # BGR as RGB. Flip it so the png's "RGB" channels are the BGR values.
+    _, png = cv2.imencode(".png", resized[:, :, ::-1])
+    features = {
+        "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[png.tobytes()])),
+        "label": tf.train.Feature(
+            float_list=tf.train.FloatList(value=[json_map[k] for k in LABEL_KEYS])
+        ),
+        "debug_image_path": tf.train.Feature(
+            bytes_list=tf.train.BytesList(value=[json_map["imagePath"].encode()])
+        ),
+    }
+    tf_example = tf.train.Example(features=tf.train.Features(feature=features))
+    return tf_example.SerializeToString()
+
+
+def shard_path(tfrecord_path: str, shard_index: int) -> str:
+    return tfrecord_path.replace(".tfrecord", f"_{shard_index:05d}.tfrecord")
+
+
+def process_label_result(tfrecord_path: str, json_maps, shard_index: int) -> int:
+    """Encode json_maps into one shard. Runs in a worker process."""
+    examples = [
+        (make_example(json_map, resize_image(image, IMAGE_W, IMAGE_H)), json_map)
+        for json_map, image in iter_images(json_maps)
+        if image is not None
+    ]
+    # Frames were decoded in order; shuffle within the shard so neighboring
+    # records aren't near-duplicates. Readers also interleave shards.
+    random.Random(shard_index).shuffle(examples)
+    path = shard_path(tfrecord_path, shard_index)
+    with tf.io.TFRecordWriter(path) as writer:
+        for example, _ in examples:
+            writer.write(example)
+    # The index allows random access without scanning the shard.
+    lengths = [len(example) for example, _ in examples]
+    write_index(path, lengths, [json_map["imagePath"] for _, json_map in examples])
+    return len(examples)
+
+
+def remove_shard(path: str):
+    for p in [path, index_path(path)]:
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def label_hash(json_map) -> str:
+    values = json.dumps([json_map[k] for k in LABEL_KEYS])
+    return hashlib.sha1(values.encode()).hexdigest()
+
+
+def source_mtimes(json_maps) -> dict:
+    sources = {parse_image_path(json_map["imagePath"])[0] for json_map in json_maps}
+    return {s: os.path.getmtime(s) if os.path.exists(s) else None for s in sources}
+
+
+class Manifest:
+    """Records which labels (and source versions) went into which shard.
+
+    It's saved after every finished shard, so an interrupted build resumes from
+    there, and reruns only encode new or changed labels.
+    """
+
+    def __init__(self, tfrecord_path: str):
+        self._tfrecord_path = tfrecord_path
+        self.path = tfrecord_path.replace(".tfrecord", ".manifest.json")
+        self.shards = {}  # shard index -> {"labels": {path: hash}, "sources": ...}
+        self.next_shard = 0
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            self.shards = {int(i): shard for i, shard in data["shards"].items()}
+            self.next_shard = data["next_shard"]
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"shards": self.shards, "next_shard": self.next_shard}, f)
+        os.replace(tmp_path, self.path)
+
+    def add(self, shard_index: int, json_maps):
+        self.shards[shard_index] = {
+            "labels": {m["imagePath"]: label_hash(m) for m in json_maps},
+            "sources": source_mtimes(json_maps),
+        }
+        self.save()
+
+    def drop_stale(self, label_result: dict) -> set:
+        """Remove shards with changed labels or sources. Return paths still done.
+
+        Shards not in the manifest (e.g., from an interrupted run) are removed
+        too. Unchanged labels of a stale shard are re-encoded into a new one.
+        """
+        current_hashes = {
+            m["imagePath"]: label_hash(m) for m in label_result.values() if m
+        }
+        done = set()
+        for shard_index, shard in list(self.shards.items()):
+            path = shard_path(self._tfrecord_path, shard_index)
+            stale = not os.path.exists(path)
+            stale = stale or any(
+                current_hashes.get(p) != h for p, h in shard["labels"].items()
+            )
+            stale = stale or any(
+                (os.path.getmtime(s) if os.path.exists(s) else None) != mtime
+                for s, mtime in shard["sources"].items()
+            )
+            if stale:
+                print(f"Dropping stale shard {path}")
+                remove_shard(path)
+                del self.shards[shard_index]
+            else:
+                done.update(shard["labels"])
+
+        known = {shard_path(self._tfrecord_path, i) for i in self.shards}
+        for path in glob.glob(self._tfrecord_path.replace(".tfrecord", "_*.tfrecord")):
+            if path not in known:
+                remove_shard(path)
+        self.save()
+        return done
+
+
+def process_label_result_raw(raw_dir: str, json_maps, offset: int):
+    """Fill rows [offset, offset + len(json_maps)) of the raw arrays.
+
+    Returns the image paths of those rows ("" for images that can't be read).
+    """
+    images, labels = open_raw_for_write(raw_dir)
+    paths = []
+    for i, (json_map, image) in enumerate(iter_images(json_maps)):
+        if image is None:
+            paths.append("")
             continue
-        image_path = json_map["imagePath"]
-        resized = get_resized(image_path, IMAGE_W, IMAGE_H)
-        features = {
-            "image": tf.train.Feature(
-                bytes_list=tf.train.BytesList(value=[tf.io.encode_png(resized).numpy()])
-            ),
-            "label": tf.train.Feature(
-                float_list=tf.train.FloatList(
-                    value=[
-                        json_map["xRatio"],
-                        json_map["yRatio"],
-                        json_map["leftRatio"],
-                        json_map["rightRatio"],
-                        json_map["yRatioObstacleMin"],
-                        json_map["yRatioObstacleMax"],
-                        json_map["xRatioObstacleMin"],
-                        json_map["xRatioObstacleMax"],
-                        json_map["obstacleConfidence"],
-                    ]
-                )
-            ),
-            "debug_image_path": tf.train.Feature(
-                bytes_list=tf.train.BytesList(value=[image_path.encode()])
-            ),
+        images[offset + i] = resize_image(image, IMAGE_W, IMAGE_H)
+        labels[offset + i] = [json_map[k] for k in LABEL_KEYS]
+        paths.append(json_map["imagePath"])
+    images.flush()
+    labels.flush()
+    return paths
+
+
+def make_raw(raw_dir: str, tasks, num_workers: int, context):
+    total = sum(len(task) for task in tasks)
+    create_raw(raw_dir, total)
+    paths = [""] * total
+    with futures.ProcessPoolExecutor(num_workers, mp_context=context) as executor:
+        offsets = [0]
+        for task in tasks[:-1]:
+            offsets.append(offsets[-1] + len(task))
+        jobs = {
+            executor.submit(process_label_result_raw, raw_dir, task, offset): offset
+            for task, offset in zip(tasks, offsets)
         }
-        tf_example = tf.train.Example(features=tf.train.Features(feature=features))
-        writer.write(tf_example.SerializeToString())
+        processed = 0
+        for job in futures.as_completed(jobs):
+            task_paths = job.result()
+            offset = jobs[job]
+            paths[offset : offset + len(task_paths)] = task_paths
+            processed += len(task_paths)
+            print(f"Processed {processed} / {total} images")
+    save_paths(raw_dir, paths)
+
+
+def make_tasks(label_result: dict, shard_size: int = SHARD_SIZE):
+    """Group labels by video, sort by frame and split into contiguous shards."""
+    by_source = defaultdict(list)
+    for json_map in label_result.values():
+        if not json_map:
+            continue
+        path, frame_index = parse_image_path(json_map["imagePath"])
+        # All still images go together; each video gets its own group.
+        source = path if frame_index is not None else None
+        by_source[source].append((frame_index or 0, json_map["imagePath"], json_map))
 
-        processed = i - start_index + 1
-        if processed % 100 == 0:
-            print(f"Thread {thread_id} processed {processed} / {total} images")
-    writer.close()
+    tasks = []
+    for entries in by_source.values():
+        entries.sort(key=lambda e: e[:2])
+        json_maps = [json_map for _, _, json_map in entries]
+        for i in range(0, len(json_maps), shard_size):
+            tasks.append(json_maps[i : i + shard_size])
+    return tasks
 
 
 @click.command()
 @click.option("--json_path", default=RESULT_JSON_PATH, help="Path to JSON file")
 @click.option("--tfrecord_path", default=TFRECORD_PATH, help="Path to TFRecord file")
-@click.option("--num_threads", default=8, help="Number of threads to use")
-def make_tfrecord(json_path: str, tfrecord_path: str, num_threads: int):
-    print(f"Converting {json_path} to {tfrecord_path} using {num_threads} threads")
+@click.option(
+    "--num_workers",
+    "--num_threads",
+    "num_workers",
+    default=os.cpu_count(),
+    help="Number of worker processes (default: one per CPU, formerly 8 threads). "
+    "--num_threads is the old name.",
+)
+@click.option("--shard_size", default=SHARD_SIZE, help="Labels per shard")
+@click.option(
+    "--raw_dir",
+    default=None,
+    help=f"Write memory-mappable arrays here (e.g., {RAW_DIR}) instead of TFRecords",
+)
+@click.option(
+    "--rebuild", is_flag=True, help="Re-encode everything instead of only changes"
+)
+def make_tfrecord(
+    json_path: str,
+    tfrecord_path: str,
+    num_workers: int,
+    shard_size: int,
+    raw_dir: str,
+    rebuild: bool,
+):
+    output = raw_dir or tfrecord_path
+    print(f"Converting {json_path} to {output} using {num_workers} workers")
 
     with open(json_path) as f:
         label_result = json.load(f)
 
-    # Shuffle
-    result_list = list(label_result.values())
-    random.shuffle(result_list)
-
-    # Split label_result into 8 threads
-    num_threads = 8
-    total_files = len(result_list)
-    files_per_thread = total_files // num_threads
-
-    threads = []
-    for i in range(num_threads):
-        start_index = i * files_per_thread
-        end_index = (
-            start_index + files_per_thread if i < num_threads - 1 else total_files
-        )
-        thread = threading.Thread(
-            target=process_label_result,
-            args=(tfrecord_path, result_list, start_index, end_index, i),
-        )
-        thread.start()
-        threads.append(thread)
-
-    # Wait for all threads to finish
-    for thread in threads:
-        thread.join()
+    # Spawn instead of fork since TensorFlow isn't fork-safe.
+    context = multiprocessing.get_context("spawn")
+    if raw_dir:
+        # The packed arrays aren't sharded, so they're always fully rebuilt.
+        make_raw(raw_dir, make_tasks(label_result, shard_size), num_workers, context)
+        return
+
+    manifest = Manifest(tfrecord_path)
+    if rebuild:
+        manifest.shards = {}
+    # This also removes shards that readers globbing *.tfrecord shouldn't see.
+    done = manifest.drop_stale(label_result)
+    pending = {
+        k: m for k, m in label_result.items() if m and m["imagePath"] not in done
+    }
+    tasks = make_tasks(pending, shard_size)
+    total = sum(len(task) for task in tasks)
+    print(f"{len(done)} labels are up to date; encoding {total} labels")
+
+    first_shard = manifest.next_shard
+    manifest.next_shard += len(tasks)
+    processed = 0
+    with futures.ProcessPoolExecutor(num_workers, mp_context=context) as executor:
+        jobs = {
+            executor.submit(process_label_result, tfrecord_path, task, i): (i, task)
+            for i, task in enumerate(tasks, first_shard)
+        }
+        for job in futures.as_completed(jobs):
+            processed += job.result()
+            manifest.add(*jobs[job])
+            print(f"Processed {processed} / {total} images")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,70 @@
+import json
+import os
+from typing import List
+
+import numpy as np
+
+from tfrecord_utils import IMAGE_H, IMAGE_W, LABEL_SIZE, is_test_path
+
+import tensorflow as tf
+
+RAW_DIR = "../data/raw"
+IMAGES_FILE = "images.npy"  # (N, IMAGE_H, IMAGE_W, 3) uint8 BGR
+LABELS_FILE = "labels.npy"  # (N, LABEL_SIZE) float32
+PATHS_FILE = "paths.json"  # N debug image paths ("" for rows that failed)
+
+
+def create_raw(raw_dir: str, size: int):
+    """Preallocate the arrays so workers can fill rows in place."""
+    os.makedirs(raw_dir, exist_ok=True)
+    image_shape = (size, IMAGE_H, IMAGE_W, 3)
+    images_path = os.path.join(raw_dir, IMAGES_FILE)
+    labels_path = os.path.join(raw_dir, LABELS_FILE)
+    images = np.lib.format.open_memmap(images_path, "w+", np.uint8, image_shape)
+    labels = np.lib.format.open_memmap(
+        labels_path, "w+", np.float32, (size, LABEL_SIZE)
+    )
+    del images, labels  # flush
+
+
+def open_raw_for_write(raw_dir: str):
+    images = np.load(os.path.join(raw_dir, IMAGES_FILE), mmap_mode="r+")
+    labels = np.load(os.path.join(raw_dir, LABELS_FILE), mmap_mode="r+")
+    return images, labels
+
+
+def save_paths(raw_dir: str, paths: List[str]):
+    with open(os.path.join(raw_dir, PATHS_FILE), "w") as f:
+        json.dump(paths, f)
+
+
+class RawDataset:
+    """Memory-mapped, pre-decoded images and labels written by make_tfrecord.py.
+
+    Rows are random access and slicing doesn't copy, so there's no png decoding
+    in the training loop.
+    """
+
+    def __init__(self, raw_dir: str = RAW_DIR):
+        self.images = np.load(os.path.join(raw_dir, IMAGES_FILE), mmap_mode="r")
+        self.labels = np.load(os.path.join(raw_dir, LABELS_FILE), mmap_mode="r")
+        with open(os.path.join(raw_dir, PATHS_FILE)) as f:
+            self.paths: List[str] = json.load(f)
+        self.valid = np.array(
+            [i for i, p in enumerate(self.paths) if p], dtype=np.int64
+        )
+
+    def __len__(self):
+        return len(self.valid)
+
+    def __getitem__(self, i: int):
+        row = self.valid[i]
+        return self.images[row], self.labels[row]
+
+    def split(self):
+        """Return (test rows, train rows), split the same way as TFRecords."""
+        if len(self.valid) == 0:
+            return self.valid, self.valid
+        paths = tf.constant([self.paths[row] for row in self.valid])
+        is_test = is_test_path(paths).numpy()
+        return self.valid[is_test], self.valid[~is_test]
@@ -0,0 +1,64 @@
+from functools import lru_cache
+from typing import Tuple
+
+import numpy as np
+
+
+def hex_to_key(hex: str) -> int:
+    """Pack "#rrggbb" into the 24-bit key of its BGR pixel (see pack_bgr)."""
+    r, g, b = (int(hex[i : i + 2], 16) for i in (1, 3, 5))
+    return (b << 16) | (g << 8) | r
+
+
+def pack_bgr(bgr: np.ndarray) -> np.ndarray:
+    keys = bgr[..., 0].astype(np.uint32) << 16
+    keys |= bgr[..., 1].astype(np.uint32) << 8
+    keys |= bgr[..., 2]
+    return keys
+
+
+class ColorRemap:
+    """ColorMappings compiled into one lookup over packed 24-bit pixels.
+
+    Mappings apply in order like separate passes would, so a -> b followed by
+    b -> c maps a to c.
+    """
+
+    def __init__(self, mappings: Tuple[Tuple[str, str], ...]):
+        table = {}
+        for from_hex, to_hex in mappings:
+            from_key, to_key = hex_to_key(from_hex), hex_to_key(to_hex)
+            for key, value in table.items():
+                if value == from_key:
+                    table[key] = to_key
+            # Pixels that were already remapped away from from_key stay put.
+            table.setdefault(from_key, to_key)
+        table = {k: v for k, v in table.items() if k != v}
+        self._from = np.array(sorted(table), dtype=np.uint32)
+        to_keys = np.array([table[k] for k in self._from], dtype=np.uint32)
+        self._to_bgr = np.stack(
+            [to_keys >> 16, (to_keys >> 8) & 0xFF, to_keys & 0xFF], axis=-1
+        ).astype(np.uint8)
+
+    def apply(self, bgr: np.ndarray) -> np.ndarray:
+        if len(self._from) == 0:
+            return bgr
+        keys = pack_bgr(bgr)
+        index = np.searchsorted(self._from, keys)
+        np.minimum(index, len(self._from) - 1, out=index)
+        hit = self._from[index] == keys
+        result = bgr.copy()
+        result[hit] = self._to_bgr[index[hit]]
+        return result
+
+
+@lru_cache(maxsize=64)
+def compile_mappings(mappings: Tuple[Tuple[str, str], ...]) -> ColorRemap:
+    """Clients send the same few mapping lists, so reuse their tables."""
+    return ColorRemap(mappings)
+
+
+def remap_colors(bgr: np.ndarray, color_mappings) -> np.ndarray:
+    """Apply the ColorMapping protos to a BGR image in a single pass."""
+    mappings = tuple((m.fromHex, m.toHex) for m in color_mappings)
+    return compile_mappings(mappings).apply(bgr)
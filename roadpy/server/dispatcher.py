@@ -0,0 +1,209 @@
+from concurrent import futures
+import os
+import threading
+import time
+from typing import Callable, List
+import zlib
+
+import grpc
+
+from proto import label_pb2
+from server.server_utils import flush_print
+from server.stats import Histogram
+
+# Without a client deadline, grpc reports ~9.2e18 seconds remaining, which
+# fails a forwarded call with DEADLINE_EXCEEDED right away.
+NO_DEADLINE_S = 1e9
+
+# Health and stats calls wait at most this long (plus WaitReady's timeout) for
+# each worker, so one dead worker can't hang them.
+FAN_OUT_TIMEOUT_S = 10.0
+
+
+def merge_health(responses: List[label_pb2.HealthStatus]):
+    merged = label_pb2.HealthStatus(ready=all(r.ready for r in responses))
+    for i, response in enumerate(responses):
+        for model in response.models:
+            merged.models.add().CopyFrom(model)
+            merged.models[-1].name = f"worker{i}/{model.name}"
+    return merged
+
+
+def merge_server_stats(responses: List[label_pb2.ServerStats]):
+    merged = label_pb2.ServerStats(
+        server=responses[0].server,
+        uptime_seconds=max(r.uptime_seconds for r in responses),
+        bucket_bounds=responses[0].bucket_bounds,
+    )
+    histograms = {}
+    for response in responses:
+        for stage in response.stages:
+            h = histograms.setdefault(stage.stage, Histogram())
+            h.count += stage.count
+            h.total += stage.total_seconds
+            h.counts = [a + b for a, b in zip(h.counts, stage.bucket_counts)]
+        for name, value in response.counters.items():
+            merged.counters[name] += value
+        for name, value in response.gauges.items():
+            merged.gauges[name] += value
+    for name, h in sorted(histograms.items()):
+        merged.stages.add(
+            stage=name,
+            count=h.count,
+            total_seconds=h.total,
+            bucket_counts=h.counts,
+            p50_ms=h.percentile(0.5) * 1000,
+            p90_ms=h.percentile(0.9) * 1000,
+            p99_ms=h.percentile(0.99) * 1000,
+        )
+    return merged
+
+
+def merge_model_stats(responses: List[label_pb2.ModelStats]):
+    merged = label_pb2.ModelStats()
+    for r in responses:
+        merged.loads += r.loads
+        merged.hits += r.hits
+        merged.evictions += r.evictions
+        merged.load_seconds += r.load_seconds
+        merged.bytes += r.bytes
+        merged.model_paths.extend(r.model_paths)
+    return merged
+
+
+# Responses of these types describe a single worker, so the dispatcher asks
+# every worker and merges their answers.
+MERGERS = {
+    "HealthStatus": merge_health,
+    "ServerStats": merge_server_stats,
+    "ModelStats": merge_model_stats,
+}
+
+
+class Dispatcher(grpc.GenericRpcHandler):
+    """Forwards the RPCs of a service to worker processes serving it.
+
+    Requests stay serialized; only routing fields are parsed. Requests that
+    touch a plot session go to the worker owning that session, others with a
+    video path go to the same worker for decoder locality, and the rest go to
+    the worker with the fewest requests in flight. A worker's error status is
+    passed on to the client as is.
+
+    Plotted requests stick to their session's worker, so clients that all use
+    the default session are served by one worker. Give each labeling client
+    its own session id, or send headless requests, to spread the load.
+    """
+
+    def __init__(self, service: str, worker_addresses: List[str]):
+        self._channels = [grpc.insecure_channel(a) for a in worker_addresses]
+        self._in_flight = [0] * len(worker_addresses)
+        self._lock = threading.Lock()
+        self._fan_out = futures.ThreadPoolExecutor(len(worker_addresses))
+        self._handlers = {}
+        descriptor = label_pb2.DESCRIPTOR.services_by_name[service]
+        for method in descriptor.methods:
+            path = f"/{descriptor.full_name}/{method.name}"
+            request_class = getattr(label_pb2, method.input_type.name)
+            if method.output_type.name in MERGERS:
+                response_class = getattr(label_pb2, method.output_type.name)
+                merge = MERGERS[method.output_type.name]
+                handler = self._fanOutHandler(
+                    path, request_class, response_class, merge
+                )
+            elif method.server_streaming:
+                handler = self._streamHandler(path, request_class)
+            else:
+                handler = self._unaryHandler(path, request_class)
+            self._handlers[path] = handler
+
+    def service(self, handler_call_details):
+        return self._handlers.get(handler_call_details.method)
+
+    def _route(self, request) -> int:
+        fields = request.DESCRIPTOR.fields_by_name
+        key = None
+        if "session_id" in fields and not getattr(request, "headless", False):
+            key = f"session:{request.session_id}"
+        elif "video_path" in fields and request.video_path:
+            key = f"video:{request.video_path}"
+        with self._lock:
+            if key is None:
+                worker = self._in_flight.index(min(self._in_flight))
+            else:
+                worker = zlib.crc32(key.encode()) % len(self._channels)
+            self._in_flight[worker] += 1
+        return worker
+
+    @staticmethod
+    def _timeout(context):
+        """Seconds left of the client's deadline, or None if it has none."""
+        remaining = context.time_remaining()
+        return remaining if remaining < NO_DEADLINE_S else None
+
+    def _done(self, worker: int):
+        with self._lock:
+            self._in_flight[worker] -= 1
+
+    def _unaryHandler(self, path: str, request_class):
+        def forward(request: bytes, context):
+            worker = self._route(request_class.FromString(request))
+            try:
+                call = self._channels[worker].unary_unary(path)
+                return call(
+                    request, timeout=self._timeout(context), wait_for_ready=True
+                )
+            except grpc.RpcError as e:
+                context.abort(e.code(), e.details())
+            finally:
+                self._done(worker)
+
+        return grpc.unary_unary_rpc_method_handler(forward)
+
+    def _streamHandler(self, path: str, request_class):
+        def forward(request: bytes, context):
+            worker = self._route(request_class.FromString(request))
+            try:
+                call = self._channels[worker].unary_stream(path)(
+                    request, timeout=self._timeout(context), wait_for_ready=True
+                )
+                context.add_callback(call.cancel)
+                yield from call
+            except grpc.RpcError as e:
+                context.abort(e.code(), e.details())
+            finally:
+                self._done(worker)
+
+        return grpc.unary_stream_rpc_method_handler(forward)
+
+    def _fanOutHandler(self, path: str, request_class, response_class, merge: Callable):
+        def forward(request: bytes, context):
+            parsed = request_class.FromString(request)
+            timeout = FAN_OUT_TIMEOUT_S + getattr(parsed, "timeout_seconds", 0)
+            remaining = self._timeout(context)
+            if remaining is not None:
+                timeout = min(timeout, remaining)
+
+            def ask(channel):
+                call = channel.unary_unary(path)
+                response = call(request, timeout=timeout, wait_for_ready=True)
+                return response_class.FromString(response)
+
+            try:
+                responses = list(self._fan_out.map(ask, self._channels))
+            except grpc.RpcError as e:
+                context.abort(e.code(), e.details())
+            return merge(responses).SerializeToString()
+
+        return grpc.unary_unary_rpc_method_handler(forward)
+
+
+def exit_with_parent(parent_pid: int):
+    """Exit this worker once the dispatcher process is gone, even if killed."""
+
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1)
+        flush_print(f"Dispatcher {parent_pid} exited; stopping worker")
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
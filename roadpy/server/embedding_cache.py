@@ -0,0 +1,64 @@
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+import threading
+
+import numpy as np
+
+from server.result_cache import frame_key
+
+if TYPE_CHECKING:
+    from segment_anything import SamPredictor
+
+# A vit_h embedding is 256x64x64 float32, i.e., 4MB.
+MAX_EMBEDDINGS = 32
+
+
+class EmbeddingCache:
+    """LRU cache of SAM image embeddings keyed by frame hash.
+
+    SamPredictor.set_image runs the image encoder, which takes seconds on CPU,
+    while a point or box prompt only runs the mask decoder in milliseconds.
+    Restoring a cached embedding makes repeated prompts on a frame cheap.
+
+    The predictor holds one image at a time, so hold `lock` from set_image
+    until the prompts are answered.
+    """
+
+    def __init__(self, predictor: "SamPredictor", max_embeddings: int = MAX_EMBEDDINGS):
+        self.lock = threading.Lock()
+        self._predictor = predictor
+        self._max_embeddings = max_embeddings
+        self._embeddings: OrderedDict[str, tuple] = OrderedDict()
+        self._current = None
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def set_image(self, image_rgb: np.ndarray):
+        key = frame_key(image_rgb, "sam")
+        if key == self._current:
+            self._count("hits")
+            return
+        entry = self._embeddings.get(key)
+        if entry is not None:
+            self._count("hits")
+            self._embeddings.move_to_end(key)
+            p = self._predictor
+            p.features, p.original_size, p.input_size = entry
+            p.is_image_set = True
+        else:
+            self._count("misses")
+            self._predictor.set_image(image_rgb)
+            p = self._predictor
+            self._embeddings[key] = (p.features, p.original_size, p.input_size)
+            while len(self._embeddings) > self._max_embeddings:
+                self._embeddings.popitem(last=False)
+                self._count("evictions")
+        self._current = key
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats, embeddings=len(self._embeddings))
@@ -1,42 +1,224 @@
+from collections import OrderedDict, deque
 from concurrent import futures
+from contextlib import nullcontext
 from pathlib import Path
+import multiprocessing
 import sys
 import os
+import threading
 import traceback
+from typing import NamedTuple
 
+from server.color_remap import remap_colors
+from server.dispatcher import Dispatcher, exit_with_parent
+from server.line_filter import filter_lines, pack_lines
+from server.model_cache import ModelCache
 from server.obstacle import ObstacleDetector
-from server.server_utils import flush_print, read_video_bgr
+from server.plotter import Plotter
+from server.read_ahead import ReadAhead
+from server.readiness import BackgroundLoad, health
+from server.result_cache import CACHE_PATH, MAX_CACHE_BYTES, ResultCache, frame_key
+from server.server_utils import decoder_stats, flush_print, read_video_bgr
+from server.stats import Stats
 from tfrecord_utils import draw_prediction
 
+import click
 import cv2
 import grpc
 import numpy as np
-import plotly.express as px
-import plotly.graph_objs as go
 
 from proto import label_pb2_grpc
 from proto import label_pb2
 
-os.environ["KERAS_BACKEND"] = "jax"
-import keras  # noqa: E402
-
 
 PNG_PATH = "/tmp/line_detection.png"
 
+# Bump this whenever the detection results change so stale cached results in
+# ResultCache are ignored.
+DETECTOR_VERSION = "1"
+
+# DetectImages reads and remaps at most this many images ahead of detection.
+READ_AHEAD = 8
+
+
+class LsdOptions(NamedTuple):
+    """Hashable LsdOptions proto for result cache keys and read-ahead keys."""
+
+    horizon_height: float = 0
+    pyramid_level: int = 0
+    min_length: float = 0
+
+    @classmethod
+    def from_proto(cls, lsd: label_pb2.LsdOptions):
+        return cls(lsd.horizon_height, lsd.pyramid_level, lsd.min_length)
+
+
+class LineOptions(NamedTuple):
+    """How LineRequest wants the detected lines sent back."""
+
+    filtered: bool = False
+    packed: bool = False
+
+    @classmethod
+    def from_request(cls, request: label_pb2.LineRequest):
+        return cls(request.filter_lines, request.pack_lines)
+
+
+def detect_segments(detector, bgr, lsd: LsdOptions) -> np.ndarray:
+    """(N, 4) full-frame x0, y0, x1, y1 of the LSD segments below the horizon.
+
+    Nothing above the horizon bounds the road, so it's cropped away, and
+    LSD on a pyrDown level finds the long road edges in a fraction of the
+    time while losing mostly short texture segments. The detector is a cv2
+    LineSegmentDetector.
+    """
+    height = bgr.shape[0]
+    top = 0
+    if 0 < lsd.horizon_height < height:
+        top = int(height - lsd.horizon_height)
+    gray = cv2.cvtColor(bgr[top:], cv2.COLOR_BGR2GRAY)
+    small = gray
+    for _ in range(lsd.pyramid_level):
+        if min(small.shape) < 32:
+            break
+        small = cv2.pyrDown(small)
+    lines, _, _, _ = detector.detect(small)
+    if lines is None:
+        return np.empty((0, 4), np.float32)
+    segments = lines.reshape(-1, 4)
+    if small is not gray:
+        # pyrDown rounds odd sizes up, so use the exact ratios.
+        segments[:, 0::2] *= gray.shape[1] / small.shape[1]
+        segments[:, 1::2] *= gray.shape[0] / small.shape[0]
+    segments[:, 1::2] += top
+    if lsd.min_length > 0:
+        dx = segments[:, 2] - segments[:, 0]
+        dy = segments[:, 3] - segments[:, 1]
+        segments = segments[np.hypot(dx, dy) >= lsd.min_length]
+    return segments
+
+
+class Session:
+    """State of one labeling client: the frame it plots on and its plots."""
+
+    def __init__(self, session_id: str):
+        self.plotter = Plotter()
+        self.lock = threading.Lock()
+        # Keep the default session's png path for tools like watch_png.sh.
+        suffix = f"_{session_id}" if session_id else ""
+        self.png_path = PNG_PATH.replace(".png", f"{suffix}.png")
+
+
+class SessionStore:
+    MAX_SESSIONS = 64
+
+    def __init__(self):
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Session:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(session_id)
+                while len(self._sessions) > self.MAX_SESSIONS:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            return session
 
 
 # TODO: rename to Detector (also in proto) since we also detect obstacles.
 class LineDetector(label_pb2_grpc.LineDetectorServicer):
-    _obstacle_detector: ObstacleDetector
+    _obstacle_detector: BackgroundLoad  # of ObstacleDetector
+    _result_cache: ResultCache
+    _sessions: SessionStore
+    _models: ModelCache
+    _stats: Stats
 
-    def __init__(self):
+    def __init__(
+        self,
+        png_renderer: str = "cv2",
+        model_budget_mb: int = 1024,
+        obstacle_detector: ObstacleDetector = None,
+        result_cache: ResultCache = None,
+        name: str = "line_detector",
+        read_ahead: int = 0,
+    ):
         super().__init__()
-        self._obstacle_detector = ObstacleDetector()
+        # DETR takes a while to load; LSD-only requests don't need to wait.
+        self._obstacle_detector = BackgroundLoad(
+            "detr", lambda: obstacle_detector or ObstacleDetector()
+        )
+        self._result_cache = result_cache or ResultCache()
+        self._sessions = SessionStore()
+        self._models = ModelCache(model_budget_mb << 20)
+        self._png_renderer = png_renderer
+        self._thread_local = threading.local()
+        self._stats = Stats(name)
+        self._image_reader = futures.ThreadPoolExecutor(max_workers=4)
+        # Interactive stepping through a video asks for nearby frames next.
+        self._read_ahead = None
+        if read_ahead > 0:
+            self._read_ahead = ReadAhead(self._speculate, read_ahead)
 
     def DetectLines(self, request: label_pb2.LineRequest, context):
         try:
             flush_print("Detecting lines")
-            return self._detect(request)
+            with self._stats.in_flight(), self._foreground():
+                with self._stats.time("detect_lines"):
+                    return self._detect(request)
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def DetectVideoRange(self, request: label_pb2.VideoRangeRequest, context):
+        try:
+            begin, end = request.begin_frame, request.end_frame
+            flush_print(f"Detecting {request.video_path} frames [{begin}, {end})")
+            with self._stats.in_flight(), self._foreground():
+                for frame_index in range(begin, end):
+                    if not context.is_active():
+                        flush_print(f"Client cancelled at frame {frame_index}")
+                        return
+                    with self._stats.time("read_video"):
+                        bgr = read_video_bgr(request.video_path, frame_index)
+                    if bgr is None:
+                        flush_print(f"Video ended at frame {frame_index}")
+                        break
+                    detection = self._detectBgr(
+                        bgr,
+                        None,
+                        obstacles=not request.skip_obstacles,
+                        lsd=LsdOptions.from_proto(request.lsd),
+                    )
+                    detection.frame_index = frame_index
+                    yield detection
+            flush_print(f"Decoder stats: {decoder_stats()}")
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def DetectImages(self, request: label_pb2.ImageBatchRequest, context):
+        try:
+            paths = request.image_paths
+            flush_print(f"Detecting {len(paths)} images")
+            with self._stats.in_flight(), self._foreground():
+                images = self._readAhead(paths, request.color_mappings)
+                lsd = LsdOptions.from_proto(request.lsd)
+                for path, bgr in images:
+                    if not context.is_active():
+                        flush_print(f"Client cancelled at {path}")
+                        return
+                    if bgr is None:
+                        flush_print(f"Failed to read {path}")
+                        yield label_pb2.LineDetection(image_path=path)
+                        continue
+                    detection = self._detectBgr(bgr, None, lsd=lsd)
+                    detection.image_path = path
+                    yield detection
         except Exception as e:
             print(f"Error: {e}")
             flush_print(traceback.format_exc())
@@ -46,48 +228,103 @@ class LineDetector(label_pb2_grpc.LineDetectorServicer):
         try:
             n_lines, n_points = len(request.lines), len(request.points)
             flush_print(f"Plotting {n_lines} lines and {n_points} points.")
-            self._plot(request)
+            session = self._sessions.get(request.session_id)
+            with session.lock, self._stats.time("plot"):
+                session.plotter.add(request)
             return label_pb2.Empty()
         except Exception as e:
             print(f"Error: {e}")
             flush_print(traceback.format_exc())
             raise
 
-    def ResetPlot(self, request: label_pb2.Empty, context):
+    def ResetPlot(self, request: label_pb2.SessionRequest, context):
         try:
             flush_print("Resetting plot")
-            self._reset()
+            session = self._sessions.get(request.session_id)
+            with session.lock:
+                session.plotter.reset()
             return label_pb2.Empty()
         except Exception as e:
             print(f"Error: {e}")
             flush_print(traceback.format_exc())
             raise
 
-    def ExportPng(self, request, context):
+    def ExportPng(self, request: label_pb2.SessionRequest, context):
         try:
-            flush_print(f"Exporting {PNG_PATH}")
-            self._savePng()
+            self._savePng(self._sessions.get(request.session_id))
             return label_pb2.Empty()
         except Exception as e:
             print(f"Error: {e}")
             flush_print(traceback.format_exc())
             raise
 
-    def _plot(self, request: label_pb2.PlotRequest):
-        for line in request.lines:
-            self._fig.add_scatter(
-                x=[line.x0, line.x1],
-                y=[line.y0, line.y1],
-                mode="lines",
-                line=dict(color=request.line_color),
-            )
-        if len(request.points) > 0:
-            self._fig.add_scatter(
-                x=[p.x for p in request.points],
-                y=[p.y for p in request.points],
-                mode="markers",
-                marker=dict(color=request.point_color),
+    def GetModelStats(self, request: label_pb2.Empty, context):
+        try:
+            stats = self._models.stats()
+            return label_pb2.ModelStats(
+                loads=stats["loads"],
+                hits=stats["hits"],
+                evictions=stats["evictions"],
+                load_seconds=stats["load_seconds"],
+                bytes=stats["bytes"],
+                model_paths=stats["models"],
             )
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def Health(self, request: label_pb2.Empty, context):
+        try:
+            return health([self._obstacle_detector])
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def WaitReady(self, request: label_pb2.WaitReadyRequest, context):
+        try:
+            return health([self._obstacle_detector], request.timeout_seconds)
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def GetStats(self, request: label_pb2.Empty, context):
+        try:
+            return self._stats.to_proto(*self._componentStats())
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def dump_stats_periodically(self, path: str, interval_s: float):
+        self._stats.dump_periodically(path, interval_s, self._componentStats)
+
+    def _componentStats(self):
+        """(counters, gauges) kept by the caches, decoders and DETR batcher."""
+        counters = {f"decoder_{k}": v for k, v in decoder_stats().items()}
+        results = self._result_cache.stats()
+        models = self._models.stats()
+        for k in ["hits", "misses", "evictions"]:
+            counters[f"result_cache_{k}"] = results[k]
+        for k in ["loads", "hits", "evictions"]:
+            counters[f"model_{k}"] = models[k]
+        if self._read_ahead:
+            read_ahead = self._read_ahead.stats()
+            for k in ["hits", "misses", "scheduled", "cancelled", "unused"]:
+                counters[f"read_ahead_{k}"] = read_ahead[k]
+        gauges = {
+            "queue_depth": (
+                self._obstacle_detector.get().queue_depth()
+                if self._obstacle_detector.ready()
+                else 0
+            ),
+            "result_cache_bytes": results["bytes"],
+            "model_bytes": models["bytes"],
+            "model_load_seconds": models["load_seconds"],
+        }
+        return counters, gauges
 
     def _detect(self, request: label_pb2.LineRequest):
         if request.video_path:
@@ -95,79 +332,322 @@ class LineDetector(label_pb2_grpc.LineDetectorServicer):
         else:
             return self._detectImage(request)
 
-    def _hex2bgr(self, hex):
-        return tuple(int(hex[i : i + 2], 16) for i in (5, 3, 1))
+    def _session(self, request: label_pb2.LineRequest):
+        return None if request.headless else self._sessions.get(request.session_id)
 
     def _detectImage(self, request: label_pb2.LineRequest):
-        bgr = cv2.imread(request.image_path)
-        for mapping in request.color_mappings:
-            from_color = self._hex2bgr(mapping.fromHex)
-            to_color = self._hex2bgr(mapping.toHex)
-            mask = cv2.inRange(bgr, from_color, from_color)
-            rest = cv2.bitwise_and(bgr, bgr, mask=~mask)
-            full = np.full(bgr.shape, to_color, dtype=np.uint8)
-            new = cv2.bitwise_and(full, full, mask=mask)
-            bgr = cv2.bitwise_or(rest, new)
-        return self._detectBgr(bgr, request.model_path)
+        with self._stats.time("read_image"):
+            bgr = cv2.imread(request.image_path)
+        with self._stats.time("color_mapping"):
+            bgr = remap_colors(bgr, request.color_mappings)
+        return self._detectBgr(
+            bgr,
+            request.model_path,
+            self._session(request),
+            obstacles=not request.skip_obstacles,
+            lsd=LsdOptions.from_proto(request.lsd),
+            lines=LineOptions.from_request(request),
+        )
+
+    def _readAhead(self, paths, color_mappings):
+        """Yield (path, remapped bgr) while the next images are being read.
+
+        Reading and remapping overlap with detection since imread and numpy
+        release the GIL.
+        """
+        pending = deque()
+        remaining = iter(paths)
+
+        def submit_next():
+            path = next(remaining, None)
+            if path is not None:
+                future = self._image_reader.submit(
+                    self._readImage, path, color_mappings
+                )
+                pending.append((path, future))
+
+        for _ in range(READ_AHEAD):
+            submit_next()
+        while pending:
+            path, future = pending.popleft()
+            submit_next()
+            yield path, future.result()
+
+    def _readImage(self, image_path: str, color_mappings):
+        with self._stats.time("read_image"):
+            bgr = cv2.imread(image_path)
+        if bgr is None:
+            return None
+        with self._stats.time("color_mapping"):
+            return remap_colors(bgr, color_mappings)
 
     def _detectVideo(self, request: label_pb2.LineRequest):
-        bgr = read_video_bgr(request.video_path, request.frame_index)
-        return self._detectBgr(bgr, request.model_path)
+        options = (
+            request.model_path,
+            not request.skip_obstacles,
+            LsdOptions.from_proto(request.lsd),
+            LineOptions.from_request(request),
+        )
+        if self._read_ahead is None:
+            with self._stats.time("read_video"):
+                bgr = read_video_bgr(request.video_path, request.frame_index)
+            model_path, obstacles, lsd, lines = options
+            return self._detectBgr(
+                bgr, model_path, self._session(request), obstacles, lsd, lines
+            )
 
-    def _detectBgr(self, bgr, modelPath: str):
-        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-        detection = label_pb2.LineDetection(
-            width=bgr.shape[1],
-            height=bgr.shape[0],
-            obstacles=self._obstacle_detector.detect(rgb),
+        key = (request.video_path, request.frame_index, options)
+        speculated = self._read_ahead.get(*key)
+        if speculated is None:
+            speculated = self._speculate(*key)
+        if speculated is None:
+            raise ValueError(f"Failed to read frame {key[1]} of {key[0]}")
+        self._read_ahead.schedule(*key)
+        bgr, detection = speculated
+        session = self._session(request)
+        if session is not None:
+            self._showFrame(bgr, request.model_path, session)
+        return detection
+
+    def _speculate(self, video_path: str, frame_index: int, options: tuple):
+        """(bgr, detection) of a video frame without plotting, for ReadAhead."""
+        model_path, obstacles, lsd, lines = options
+        with self._stats.time("read_video"):
+            bgr = read_video_bgr(video_path, frame_index)
+        if bgr is None:
+            return None
+        detection = self._detectBgr(
+            bgr, model_path, obstacles=obstacles, lsd=lsd, lines=lines
         )
+        return bgr, detection
 
-        if not modelPath:
-            gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
-            lines, _, _, _ = self._detector.detect(gray)
-            if lines is not None:
-                for line in lines:
-                    x0, y0, x1, y1 = line[0]
-                    detection.lines.append(label_pb2.Line(x0=x0, y0=y0, x1=x1, y1=y1))
-        else:
-            if self._modelPath != modelPath:
-                self._modelPath = modelPath
-                self._model = keras.models.load_model(modelPath)
-            predicted_bgr = draw_prediction(self._model, bgr)
-            rgb = cv2.cvtColor(predicted_bgr, cv2.COLOR_BGR2RGB)
+    def _foreground(self):
+        """Pauses read-ahead speculation while a request is served."""
+        return self._read_ahead.foreground() if self._read_ahead else nullcontext()
 
-        self._fig = px.imshow(rgb)
-        self._rgb = rgb
+    def _detectBgr(
+        self,
+        bgr,
+        modelPath: str,
+        session: Session = None,
+        obstacles: bool = True,
+        lsd: LsdOptions = LsdOptions(),
+        lines: LineOptions = LineOptions(),
+    ):
+        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        useLsd = not modelPath
+        version = f"{DETECTOR_VERSION}:{ObstacleDetector.THRESHOLD}:{useLsd}"
+        if not obstacles:
+            version += ":no_obstacles"
+        if useLsd and lsd != LsdOptions():
+            version += ":lsd" + ",".join(map(str, lsd))
+        if useLsd and lines != LineOptions():
+            version += f":lines{lines.filtered:d}{lines.packed:d}"
+        self._stats.count("frames")
+        with self._stats.time("cache_get"):
+            key = frame_key(bgr, version)
+            detection = self._result_cache.get(key)
+        if detection is None:
+            detection = self._detectRgb(bgr, rgb, useLsd, obstacles, lsd, lines)
+            with self._stats.time("cache_put"):
+                self._result_cache.put(key, detection)
 
+        if session is not None:
+            self._showFrame(bgr, modelPath, session)
         return detection
 
-    def _reset(self):
-        self._fig = px.imshow(self._rgb)
+    def _showFrame(self, bgr, modelPath: str, session: Session):
+        """Set the frame to plot on, with the model's prediction if any."""
+        if modelPath:
+            # The prediction is only drawn into the plot, so skip it otherwise.
+            with self._stats.time("model_get"):
+                engine = self._models.get(modelPath)
+            with self._stats.time("predict"):
+                bgr = draw_prediction(engine, bgr)
+        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        with session.lock:
+            session.plotter.set_image(rgb)
 
-    def _savePng(self):
+    def _detectRgb(
+        self,
+        bgr,
+        rgb,
+        useLsd: bool,
+        obstacles: bool = True,
+        lsd: LsdOptions = LsdOptions(),
+        lines: LineOptions = LineOptions(),
+    ) -> label_pb2.LineDetection:
+        detection = label_pb2.LineDetection(width=bgr.shape[1], height=bgr.shape[0])
+        if obstacles:
+            with self._stats.time("detr"):
+                detector = self._obstacle_detector.get()
+                detection.obstacles.extend(detector.detect(rgb))
+        if useLsd:
+            with self._stats.time("lsd"):
+                segments = detect_segments(self._lsd(), bgr, lsd)
+            if lines.filtered:
+                with self._stats.time("filter_lines"):
+                    right, left = filter_lines(
+                        segments, detection.width, detection.height
+                    )
+                segments = np.concatenate([right, left])
+                detection.filtered = True
+                detection.right_line_count = len(right)
+            if lines.packed:
+                detection.packed_lines = pack_lines(segments)
+            else:
+                for x0, y0, x1, y1 in segments.tolist():
+                    line = label_pb2.Line(x0=x0, y0=y0, x1=x1, y1=y1)
+                    detection.lines.append(line)
+        return detection
+
+    def _savePng(self, session: Session):
         # Image Viewer can show this png without smoothing and auto-reload.
-        with open(PNG_PATH, "wb") as f:
-            f.write(self._fig.to_image(format="png"))
-        flush_print(f"Saved {PNG_PATH}")
+        with session.lock, self._stats.time(f"save_png_{self._png_renderer}"):
+            session.plotter.save_png(session.png_path, self._png_renderer)
+        flush_print(f"Saved {session.png_path}")
 
-    _detector = cv2.createLineSegmentDetector()
-    _rgb: np.ndarray = None  # cached RGB image for resetting plot
-    _fig: go.Figure = None
-    _modelPath: str = None
-    _model: keras.Model = None
+    def _lsd(self):
+        # cv2's LineSegmentDetector isn't safe to share between threads.
+        if not hasattr(self._thread_local, "lsd"):
+            self._thread_local.lsd = cv2.createLineSegmentDetector()
+        return self._thread_local.lsd
 
 
-def serve():
+@click.command()
+@click.option(
+    "--png_renderer",
+    type=click.Choice(["cv2", "plotly"]),
+    default="cv2",
+    help="cv2 draws on the frame directly; plotly is slower but has axes.",
+)
+@click.option(
+    "--model_budget_mb",
+    default=1024,
+    help="Evict least recently used keras models beyond this many MB of weights.",
+)
+@click.option(
+    "--stats_path",
+    default=None,
+    help="Periodically write GetStats in the Prometheus text format to this file.",
+)
+@click.option("--stats_interval", default=10.0, help="Seconds between stats dumps.")
+@click.option(
+    "--workers",
+    default=1,
+    help="Worker processes, each with its own models, behind the same socket. "
+    "Plotted requests of one session id all go to the same worker.",
+)
+@click.option(
+    "--read_ahead",
+    default=0,
+    help="After a video frame, detect this many next frames (and the previous "
+    "one) in the background for interactive stepping.",
+)
+def serve(
+    png_renderer: str,
+    model_budget_mb: int,
+    stats_path: str,
+    stats_interval: float,
+    workers: int,
+    read_ahead: int,
+):
     name: str = Path(__file__).stem
     pid = os.getpid()
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    label_pb2_grpc.add_LineDetectorServicer_to_server(LineDetector(), server)
-    server.add_insecure_port(f"unix:///tmp/{name}_{pid}.sock")
+    address = f"unix:///tmp/{name}_{pid}.sock"
+    detector_options = {
+        "png_renderer": png_renderer,
+        "model_budget_mb": model_budget_mb,
+        "read_ahead": read_ahead,
+    }
+    if workers <= 1:
+        server = make_server(address, stats_path, stats_interval, **detector_options)
+    else:
+        server = make_dispatcher(
+            address, workers, stats_path, stats_interval, detector_options
+        )
     server.start()
     print(f"Server started with pid {pid}")
     sys.stdout.flush()
     server.wait_for_termination()
 
 
+def make_server(
+    address: str, stats_path: str, stats_interval: float, **detector_options
+) -> grpc.Server:
+    """A server of one LineDetector(**detector_options)."""
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    detector = LineDetector(**detector_options)
+    if stats_path:
+        detector.dump_stats_periodically(stats_path, stats_interval)
+    label_pb2_grpc.add_LineDetectorServicer_to_server(detector, server)
+    server.add_insecure_port(address)
+    return server
+
+
+def run_worker(
+    index: int,
+    address: str,
+    parent_pid: int,
+    stats_path: str,
+    stats_interval: float,
+    cache_bytes: int,
+    detector_options: dict,
+):
+    """Entry point of a worker process started by make_dispatcher."""
+    exit_with_parent(parent_pid)
+    # Workers don't share the SQLite file since each tracks its size in memory
+    # and concurrent writers would contend for the database lock.
+    cache_path = CACHE_PATH.with_stem(f"{CACHE_PATH.stem}_w{index}")
+    server = make_server(
+        address,
+        stats_path,
+        stats_interval,
+        name=f"line_detector_w{index}",
+        result_cache=ResultCache(cache_path, cache_bytes),
+        **detector_options,
+    )
+    server.start()
+    flush_print(f"Worker {index} started with pid {os.getpid()} on {address}")
+    server.wait_for_termination()
+
+
+def make_dispatcher(
+    address: str,
+    workers: int,
+    stats_path: str,
+    stats_interval: float,
+    detector_options: dict,
+) -> grpc.Server:
+    """Start worker processes and a server forwarding requests to them.
+
+    Each worker has its own GIL, models and caches; the workers split the
+    result cache budget. Requests are forwarded with wait_for_ready, so the
+    socket can accept them before workers bind.
+    """
+    # Spawn instead of fork since grpc and torch aren't fork-safe.
+    context = multiprocessing.get_context("spawn")
+    worker_addresses = []
+    for i in range(workers):
+        worker_address = address.replace(".sock", f"_w{i}.sock")
+        worker_stats_path = None
+        if stats_path:
+            root, ext = os.path.splitext(stats_path)
+            worker_stats_path = f"{root}_w{i}{ext}"
+        cache_bytes = MAX_CACHE_BYTES // workers
+        args = (worker_stats_path, stats_interval, cache_bytes, detector_options)
+        context.Process(
+            target=run_worker,
+            args=(i, worker_address, os.getpid(), *args),
+            daemon=True,
+        ).start()
+        worker_addresses.append(worker_address)
+    # Streaming requests hold a dispatcher thread for as long as they run.
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10 * workers))
+    server.add_generic_rpc_handlers([Dispatcher("LineDetector", worker_addresses)])
+    server.add_insecure_port(address)
+    return server
+
+
 if __name__ == "__main__":
     serve()
@@ -0,0 +1,110 @@
+import math
+from typing import Tuple
+
+import numpy as np
+
+# Keep these in sync with roadart/lib/src/line_filter.dart and line_merger.dart.
+MIN_LENGTH = 20.0
+Y_RATIO_RANGE = (0.3, 0.95)
+LEFT_X_RANGE = (0.0, 0.5)
+RIGHT_X_RANGE = (0.5, 1.0)
+MIN_DX_OVER_DY = math.tan(math.radians(30))
+DISTANCE_RATIO = 0.01  # 1% of the image diagonal
+EPSILON = 1e-8
+
+
+def normalize(lines) -> np.ndarray:
+    """(N, 4) float64 x0, y0, x1, y1 with x0 <= x1, like Line in Dart."""
+    lines = np.array(lines, np.float64).reshape(-1, 4)
+    swap = lines[:, 0] > lines[:, 2]
+    lines[swap] = lines[swap][:, [2, 3, 0, 1]]
+    return lines
+
+
+def _within(values: np.ndarray, value_range: Tuple[float, float]) -> np.ndarray:
+    low, high = value_range
+    return (values >= low) & (values <= high)
+
+
+def accepts(
+    lines: np.ndarray,
+    width: int,
+    height: int,
+    x_range: Tuple[float, float],
+    dx_over_dy_range: Tuple[float, float],
+) -> np.ndarray:
+    """Mask of the normalized lines passing LineFilter's conditions for a side."""
+    x0, y0, x1, y1 = lines.T
+    dx, dy = x1 - x0, y1 - y0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dx_over_dy = dx / dy
+    return (
+        (np.hypot(dx, dy) >= MIN_LENGTH)
+        & _within(x0 / width, x_range)
+        & _within(y0 / height, Y_RATIO_RANGE)
+        & _within(x1 / width, x_range)
+        & _within(y1 / height, Y_RATIO_RANGE)
+        & (np.abs(dy) >= EPSILON)
+        & _within(dx_over_dy, dx_over_dy_range)
+    )
+
+
+def _distance(points: np.ndarray, lines: np.ndarray) -> np.ndarray:
+    """Distances from the points to the infinite lines through the segments."""
+    start = lines[:, :2]
+    direction = lines[:, 2:] - start
+    length = np.linalg.norm(direction, axis=1, keepdims=True)
+    # Like vector_math, normalizing a zero vector leaves it as is.
+    direction = np.divide(
+        direction, length, out=np.zeros_like(direction), where=length > 0
+    )
+    offset = points - start
+    along = np.sum(offset * direction, axis=1, keepdims=True)
+    return np.linalg.norm(offset - direction * along, axis=1)
+
+
+def merge(lines: np.ndarray, width: int, height: int) -> np.ndarray:
+    """LineMerger.merge of normalized lines.
+
+    Sorted by start x, each run of neighbors that LineMerger.shouldMerge
+    accepts becomes one line from the run's first start to its last end.
+    """
+    if len(lines) < 2:
+        return lines
+    threshold = math.hypot(width, height) * DISTANCE_RATIO
+    lines = lines[np.argsort(lines[:, 0], kind="stable")]
+    left, right = lines[:-1], lines[1:]
+    should_merge = left[:, 2] <= right[:, 0]
+    # As in Dart, right's end is compared against left's start.
+    should_merge &= np.sign(left[:, 3] - left[:, 1]) == np.sign(
+        right[:, 3] - left[:, 1]
+    )
+    # Dart also checks right's end against right itself, which always passes.
+    for points, other in [
+        (left[:, :2], right),
+        (left[:, 2:], right),
+        (right[:, :2], left),
+    ]:
+        should_merge &= _distance(points, other) <= threshold
+    first = np.flatnonzero(np.concatenate([[True], ~should_merge]))
+    last = np.append(first[1:] - 1, len(lines) - 1)
+    return np.concatenate([lines[first, :2], lines[last, 2:]], axis=1)
+
+
+def filter_lines(lines, width: int, height: int) -> Tuple[np.ndarray, np.ndarray]:
+    """(right, left) merged lines as LineFilter.process classifies them.
+
+    Running this on the server spares sending and filtering thousands of raw
+    LSD segments per frame when the client only needs the road boundaries.
+    """
+    lines = normalize(lines)
+    right = accepts(lines, width, height, RIGHT_X_RANGE, (MIN_DX_OVER_DY, math.inf))
+    left = ~right & accepts(
+        lines, width, height, LEFT_X_RANGE, (-math.inf, -MIN_DX_OVER_DY)
+    )
+    return merge(lines[right], width, height), merge(lines[left], width, height)
+
+
+def pack_lines(lines: np.ndarray) -> bytes:
+    """Little-endian float32 x0, y0, x1, y1 of each line."""
+    return np.ascontiguousarray(lines, "<f4").tobytes()
@@ -0,0 +1,42 @@
+import json
+from typing import List
+
+import numpy as np
+
+
+def encode_rle(mask: np.ndarray) -> List[int]:
+    """Alternating lengths of False and True runs of the row-major pixels.
+
+    The first run is False, so it's 0 if the first pixel is True.
+    """
+    flat = mask.ravel()
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate([[0], changes, [flat.size]]))
+    if flat.size and flat[0]:
+        counts = np.concatenate([[0], counts])
+    return counts.tolist()
+
+
+def decode_rle(counts: List[int], height: int, width: int) -> np.ndarray:
+    values = np.arange(len(counts)) % 2 == 1
+    return np.repeat(values, counts).reshape(height, width)
+
+
+def rle_line(frame_index: int, mask: np.ndarray, regenerated: bool) -> str:
+    """One JSON line of a range's mask file."""
+    record = {
+        "frame_index": frame_index,
+        "height": mask.shape[0],
+        "width": mask.shape[1],
+        "counts": encode_rle(mask),
+        "regenerated": regenerated,
+    }
+    return json.dumps(record, separators=(",", ":")) + "\n"
+
+
+def read_rle_file(path: str):
+    """Yield (frame_index, mask) of a file written with rle_line."""
+    with open(path) as f:
+        for line in f:
+            r = json.loads(line)
+            yield r["frame_index"], decode_rle(r["counts"], r["height"], r["width"])
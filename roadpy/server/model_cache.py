@@ -0,0 +1,73 @@
+from collections import OrderedDict
+import os
+import threading
+import time
+
+from inference import InferenceBackend, load_backend
+
+MAX_MODEL_BYTES = 1 << 30
+
+
+class ModelCache:
+    """Thread-safe LRU cache of inference backends keyed by path and mtime.
+
+    The backend is picked by the file extension (.keras, .onnx or .tflite).
+
+    Models are evicted once the total size of their weights exceeds the budget.
+    The most recently used model is always kept, even if it alone is over it.
+    """
+
+    def __init__(self, max_bytes: int = MAX_MODEL_BYTES):
+        self._max_bytes = max_bytes
+        self._models: OrderedDict[tuple, InferenceBackend] = OrderedDict()
+        self._sizes: dict[tuple, int] = {}
+        self._lock = threading.Lock()
+        self._loading: dict[tuple, threading.Lock] = {}
+        self._stats = {"loads": 0, "hits": 0, "evictions": 0, "load_seconds": 0.0}
+
+    def get(self, path: str) -> InferenceBackend:
+        # A re-saved checkpoint (e.g., ignore/best_check.keras) gets reloaded.
+        key = (path, os.path.getmtime(path))
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self._stats["hits"] += 1
+                return self._models[key]
+            loading = self._loading.setdefault(key, threading.Lock())
+        # Load outside the cache lock so other models stay available, but make
+        # concurrent requests for the same model wait for a single load.
+        with loading:
+            with self._lock:
+                if key in self._models:
+                    self._stats["hits"] += 1
+                    return self._models[key]
+            start = time.perf_counter()
+            model = load_backend(path)
+            # Compile up front so the first real frame doesn't wait for JAX.
+            model.warm_up()
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._stats["loads"] += 1
+                self._stats["load_seconds"] += seconds
+                self._models[key] = model
+                self._sizes[key] = model.nbytes()
+                self._evict()
+                self._loading.pop(key, None)
+        return model
+
+    def _evict(self):
+        while len(self._models) > 1 and self._total_bytes() > self._max_bytes:
+            key, _ = self._models.popitem(last=False)
+            del self._sizes[key]
+            self._stats["evictions"] += 1
+
+    def _total_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(
+                self._stats,
+                bytes=self._total_bytes(),
+                models=[path for path, _ in self._models],
+            )
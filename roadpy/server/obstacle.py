@@ -1,50 +1,115 @@
-from typing import List
-import torch
-from transformers import DetrImageProcessor, DetrForObjectDetection
+from concurrent import futures
+from typing import TYPE_CHECKING, List
+import queue
+import threading
+import time
 
 from proto.label_pb2 import Obstacle
 
+# torch and transformers take seconds to import, so they're imported when the
+# detector is constructed, which the servers do in the background.
+if TYPE_CHECKING:
+    from transformers import DetrImageProcessor, DetrForObjectDetection
+
 DETR_MODEL_PATH = "facebook/detr-resnet-50"
 
 
 class ObstacleDetector:
     THRESHOLD = 0.6
+    MAX_BATCH_SIZE = 8
+    MAX_DELAY_MS = 10  # how long the first request waits for others to join
 
-    _processor: DetrImageProcessor
-    _model: DetrForObjectDetection
+    _processor: "DetrImageProcessor"
+    _model: "DetrForObjectDetection"
     _device: str
 
-    def __init__(self):
+    def __init__(
+        self,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_delay_ms: float = MAX_DELAY_MS,
+        processor: "DetrImageProcessor" = None,
+        model: "DetrForObjectDetection" = None,
+    ):
+        import torch
+        from transformers import DetrImageProcessor, DetrForObjectDetection
+
+        # The processor and model default to the pretrained DETR_MODEL_PATH.
         kwargs = {"revision": "no_timm"}
-        self._processor = DetrImageProcessor.from_pretrained(DETR_MODEL_PATH, **kwargs)
-        self._model = DetrForObjectDetection.from_pretrained(DETR_MODEL_PATH, **kwargs)
+        self._processor = processor or DetrImageProcessor.from_pretrained(
+            DETR_MODEL_PATH, **kwargs
+        )
+        self._model = model or DetrForObjectDetection.from_pretrained(
+            DETR_MODEL_PATH, **kwargs
+        )
         self._device = "cpu"
         if torch.cuda.is_available():
             self._device = "cuda"
         elif torch.backends.mps.is_available():
             self._device = "mps"
-        self._model = self._model.to(self._device)
+        self._model = self._model.to(self._device).eval()
+        self._id2label = self._model.config.id2label
+
+        self._max_batch_size = max_batch_size
+        self._max_delay_ms = max_delay_ms
+        self._queue: queue.Queue = queue.Queue()
+        threading.Thread(target=self._batch_loop, daemon=True).start()
 
     def detect(self, image) -> List[Obstacle]:
-        inputs = self._processor(images=image, return_tensors="pt").to(self._device)
-        outputs = self._model(**inputs)
-        results = self._processor.post_process_object_detection(
-            outputs, threshold=self.THRESHOLD
-        )[0]
-
-        obstacles: List[Obstacle] = []
-        for score, label, box in zip(
-            results["scores"], results["labels"], results["boxes"]
-        ):
-            ltrb = box.tolist()
-            obstacles.append(
-                Obstacle(
-                    l=ltrb[0],
-                    t=ltrb[1],
-                    r=ltrb[2],
-                    b=ltrb[3],
-                    label=self._model.config.id2label[label.item()],
-                    confidence=score.item(),
-                )
+        """Detect obstacles of one image, batched with concurrent callers."""
+        future = futures.Future()
+        self._queue.put((image, future))
+        return future.result()
+
+    def queue_depth(self) -> int:
+        """Number of images waiting for a batch."""
+        return self._queue.qsize()
+
+    def detect_batch(self, images) -> List[List[Obstacle]]:
+        import torch
+
+        with torch.inference_mode():
+            inputs = self._processor(images=images, return_tensors="pt")
+            outputs = self._model(**inputs.to(self._device))
+            results = self._processor.post_process_object_detection(
+                outputs, threshold=self.THRESHOLD
+            )
+        return [self._to_obstacles(result) for result in results]
+
+    def _to_obstacles(self, result) -> List[Obstacle]:
+        # Convert whole tensors at once instead of calling item() per element.
+        scores = result["scores"].tolist()
+        labels = result["labels"].tolist()
+        boxes = result["boxes"].tolist()
+        return [
+            Obstacle(
+                l=left,
+                t=top,
+                r=right,
+                b=bottom,
+                label=self._id2label[label],
+                confidence=score,
             )
-        return obstacles
+            for score, label, (left, top, right, bottom) in zip(scores, labels, boxes)
+        ]
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self._max_delay_ms / 1000
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.detect_batch([image for image, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), obstacles in zip(batch, results):
+                future.set_result(obstacles)
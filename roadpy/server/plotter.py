@@ -0,0 +1,89 @@
+from typing import List
+
+import cv2
+import numpy as np
+
+from proto import label_pb2
+
+# Colors used by the labeler, in BGR. Other colors should be "#rrggbb".
+_NAMED_BGR = {
+    "red": (0, 0, 255),
+    "green": (0, 128, 0),
+    "blue": (255, 0, 0),
+    "yellow": (0, 255, 255),
+    "black": (0, 0, 0),
+    "white": (255, 255, 255),
+}
+
+
+def color_to_bgr(color: str):
+    if color.startswith("#"):
+        return tuple(int(color[i : i + 2], 16) for i in (5, 3, 1))
+    return _NAMED_BGR.get(color, _NAMED_BGR["blue"])
+
+
+class Plotter:
+    """Records plot requests on top of the last detected frame.
+
+    The plotly figure is only built when a png is exported with the plotly
+    renderer, so headless or cv2-rendered runs never pay for it.
+    """
+
+    def __init__(self):
+        self._rgb: np.ndarray = None
+        self._plots: List[label_pb2.PlotRequest] = []
+
+    def set_image(self, rgb: np.ndarray):
+        self._rgb = rgb
+        self._plots = []
+
+    def reset(self):
+        self._plots = []
+
+    def add(self, request: label_pb2.PlotRequest):
+        plot = label_pb2.PlotRequest()
+        plot.CopyFrom(request)
+        self._plots.append(plot)
+
+    def save_png(self, path: str, renderer: str = "cv2"):
+        if renderer == "plotly":
+            png = self._figure().to_image(format="png")
+        else:
+            _, png = cv2.imencode(".png", self._draw_bgr())
+        with open(path, "wb") as f:
+            f.write(png)
+
+    def _draw_bgr(self) -> np.ndarray:
+        bgr = cv2.cvtColor(self._rgb, cv2.COLOR_RGB2BGR)
+        for plot in self._plots:
+            line_color = color_to_bgr(plot.line_color)
+            for line in plot.lines:
+                p0 = (round(line.x0), round(line.y0))
+                p1 = (round(line.x1), round(line.y1))
+                cv2.line(bgr, p0, p1, line_color, 2, cv2.LINE_AA)
+            point_color = color_to_bgr(plot.point_color)
+            for p in plot.points:
+                cv2.circle(bgr, (round(p.x), round(p.y)), 4, point_color, -1)
+        return bgr
+
+    def _figure(self):
+        # Plotly and kaleido are slow to import, so only do it when needed.
+        import plotly.express as px
+
+        fig = px.imshow(self._rgb)
+        for plot in self._plots:
+            for line in plot.lines:
+                fig.add_scatter(
+                    x=[line.x0, line.x1],
+                    y=[line.y0, line.y1],
+                    mode="lines",
+                    line=dict(color=plot.line_color),
+                )
+            if len(plot.points) > 0:
+                fig.add_scatter(
+                    x=[p.x for p in plot.points],
+                    y=[p.y for p in plot.points],
+                    mode="markers",
+                    marker=dict(color=plot.point_color),
+                )
+        return fig
@@ -0,0 +1,105 @@
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import threading
+import traceback
+from typing import Callable
+
+from server.server_utils import flush_print
+
+
+class ReadAhead:
+    """Speculatively detects the frames around the last requested one.
+
+    After frame N of a video is served, frames N+1..N+k and N-1 are decoded
+    and detected on one background thread, so stepping through a video finds
+    them ready. Speculation pauses while requests are in flight, and a request
+    elsewhere cancels the frames that are no longer around it.
+
+    Results are keyed by (video_path, frame_index, options), where options are
+    whatever else changes the detection (e.g., the model path).
+    """
+
+    def __init__(self, detect: Callable, frames: int, max_results: int = None):
+        # detect(video_path, frame_index, options) returns (bgr, detection) or
+        # None if there's no such frame.
+        self._detect = detect
+        self._frames = frames
+        self._max_results = max_results or 2 * (frames + 1)
+        self._cond = threading.Condition()
+        self._pending: deque[tuple] = deque()
+        self._results: OrderedDict[tuple, list] = OrderedDict()  # [bgr, det, used]
+        self._foreground = 0
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "scheduled": 0,
+            "cancelled": 0,
+            "unused": 0,
+        }
+        threading.Thread(target=self._run, name="read_ahead", daemon=True).start()
+
+    def get(self, video_path: str, frame_index: int, options: tuple):
+        """Return the speculated (bgr, detection), or None."""
+        key = (video_path, frame_index, options)
+        with self._cond:
+            result = self._results.get(key)
+            if result is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            self._results.move_to_end(key)
+            result[2] = True
+            return result[0], result[1]
+
+    def schedule(self, video_path: str, frame_index: int, options: tuple):
+        """Speculate around frame_index, replacing what's still pending."""
+        indices = list(range(frame_index + 1, frame_index + self._frames + 1))
+        if frame_index > 0:
+            indices.append(frame_index - 1)
+        keys = [(video_path, i, options) for i in indices]
+        with self._cond:
+            wanted = set(keys)
+            self._stats["cancelled"] += sum(k not in wanted for k in self._pending)
+            self._pending = deque(k for k in keys if k not in self._results)
+            self._stats["scheduled"] += len(self._pending)
+            self._cond.notify()
+
+    @contextmanager
+    def foreground(self):
+        """Pause speculation while a request is being served."""
+        with self._cond:
+            self._foreground += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._foreground -= 1
+                self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = dict(self._stats, buffered=len(self._results))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending or self._foreground:
+                    self._cond.wait()
+                key = self._pending.popleft()
+            try:
+                result = self._detect(*key)
+            except Exception as e:
+                print(f"Error: read ahead of {key[:2]} failed: {e}")
+                flush_print(traceback.format_exc())
+                continue
+            if result is None:
+                continue
+            with self._cond:
+                self._results[key] = [*result, False]
+                while len(self._results) > self._max_results:
+                    _, (_, _, used) = self._results.popitem(last=False)
+                    if not used:
+                        self._stats["unused"] += 1
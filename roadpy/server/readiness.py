@@ -0,0 +1,67 @@
+import threading
+import time
+import traceback
+from typing import Callable, List
+
+from proto import label_pb2
+from server.server_utils import flush_print
+
+
+class BackgroundLoad:
+    """Loads a model on a daemon thread so the server can bind right away.
+
+    Requests that need the model block in get() until it's loaded; others,
+    e.g., LSD-only detection, don't have to wait at all.
+    """
+
+    def __init__(self, name: str, load: Callable):
+        self.name = name
+        self._load = load
+        self._value = None
+        self._error: Exception = None
+        self._start = time.perf_counter()
+        self._seconds = None
+        self._loaded = threading.Event()
+        threading.Thread(target=self._run, name=f"load_{name}", daemon=True).start()
+
+    def _run(self):
+        try:
+            self._value = self._load()
+        except Exception as e:
+            self._error = e
+            flush_print(f"Failed to load {self.name}: {e}")
+            flush_print(traceback.format_exc())
+        self._seconds = time.perf_counter() - self._start
+        flush_print(f"Loaded {self.name} in {self._seconds:.1f}s")
+        self._loaded.set()
+
+    def ready(self) -> bool:
+        return self._loaded.is_set() and self._error is None
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._loaded.wait(timeout)
+
+    def get(self):
+        self._loaded.wait()
+        if self._error is not None:
+            raise RuntimeError(f"{self.name} failed to load") from self._error
+        return self._value
+
+    def status(self) -> label_pb2.ModelStatus:
+        loaded = self._loaded.is_set()
+        seconds = self._seconds if loaded else time.perf_counter() - self._start
+        return label_pb2.ModelStatus(
+            name=self.name,
+            ready=self.ready(),
+            load_seconds=seconds,
+            error=str(self._error) if self._error else "",
+        )
+
+
+def health(loads: List[BackgroundLoad], timeout: float = 0):
+    """HealthStatus of the loads after waiting up to timeout seconds for all."""
+    deadline = time.monotonic() + timeout
+    for load in loads:
+        load.wait(max(deadline - time.monotonic(), 0))
+    statuses = [load.status() for load in loads]
+    return label_pb2.HealthStatus(ready=all(s.ready for s in statuses), models=statuses)
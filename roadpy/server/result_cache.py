@@ -0,0 +1,99 @@
+from pathlib import Path
+import hashlib
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from proto import label_pb2
+
+CACHE_PATH = Path(__file__).parent.parent / "ignore" / "line_detection_cache.sqlite"
+MAX_CACHE_BYTES = 1 << 30
+
+
+def frame_key(bgr: np.ndarray, version: str) -> str:
+    """Hash of the decoded frame plus anything else that changes the result."""
+    h = hashlib.blake2b(digest_size=20)
+    h.update(f"{version}:{bgr.shape}:{bgr.dtype}".encode())
+    h.update(np.ascontiguousarray(bgr).data)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """SQLite-backed LineDetection cache with a size cap and LRU eviction.
+
+    It persists across server restarts so relabeling the same frames (e.g.,
+    after tweaking the Dart line filter) skips the detectors entirely.
+    """
+
+    def __init__(self, path: Path = CACHE_PATH, max_bytes: int = MAX_CACHE_BYTES):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        # Hits commit a last_used update. With WAL and synchronous=NORMAL, a
+        # commit appends to the log without an fsync, so hits stay cheap.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_used REAL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results(last_used)"
+        )
+        self._db.commit()
+        (total,) = self._db.execute("SELECT SUM(size) FROM results").fetchone()
+        self._total_bytes = total or 0
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key: str) -> label_pb2.LineDetection:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            self._db.execute(
+                "UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key)
+            )
+            self._db.commit()
+        return label_pb2.LineDetection.FromString(row[0])
+
+    def put(self, key: str, detection: label_pb2.LineDetection):
+        value = detection.SerializeToString()
+        with self._lock:
+            old = self._db.execute(
+                "SELECT size FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time.time()),
+            )
+            self._total_bytes += len(value) - (old[0] if old else 0)
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        while self._total_bytes > self._max_bytes:
+            oldest = self._db.execute(
+                "SELECT key, size FROM results ORDER BY last_used LIMIT 64"
+            ).fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if self._total_bytes <= self._max_bytes:
+                    break
+                self._db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._total_bytes -= size
+                self._stats["evictions"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats, bytes=self._total_bytes)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
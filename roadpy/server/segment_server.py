@@ -1,27 +1,73 @@
 from concurrent import futures
 import os
 import traceback
-from typing import List
+from typing import TYPE_CHECKING, List
+import click
 import cv2
 import grpc
 import numpy as np
-import torch
-import wget
 import logging
 
 from pathlib import Path
-from segment_anything import SamAutomaticMaskGenerator, SamPredictor, sam_model_registry
 
 from proto import label_pb2, label_pb2_grpc
-from server.server_utils import flush_print, read_video_bgr
+from server.embedding_cache import EmbeddingCache
+from server.mask_rle import rle_line
+from server.readiness import BackgroundLoad, health
+from server.server_utils import decoder_stats, flush_print, read_video_bgr
+from server.stats import Stats
+
+# torch and segment_anything are imported by _loadSam in the background.
+if TYPE_CHECKING:
+    from segment_anything import SamAutomaticMaskGenerator, SamPredictor
 
 BOTTOM_RATIO = 1.0 - 80.0 / 360
 
+# SegmentVideoRange re-runs the automatic mask generator when the propagated
+# mask drifts this much from the previous frame's.
+MIN_IOU = 0.7
+MAX_AREA_CHANGE = 0.3
+
+
+def mask_iou(a: np.ndarray, b: np.ndarray) -> float:
+    union = np.count_nonzero(a | b)
+    return np.count_nonzero(a & b) / union if union else 1.0
+
+
+def prompts_from_mask(mask: np.ndarray, point: np.ndarray):
+    """(points, labels, box) that carry a mask over to the next frame.
+
+    The box is the mask's bounding box, and the point is the mask pixel
+    closest to `point` (x, y), e.g., the bottom center of the road.
+    """
+    ys, xs = np.nonzero(mask)
+    box = np.array([xs.min(), ys.min(), xs.max(), ys.max()])
+    closest = np.argmin((xs - point[0]) ** 2 + (ys - point[1]) ** 2)
+    return np.array([[xs[closest], ys[closest]]]), np.array([1]), box
+
+
 class SamDetector(label_pb2_grpc.Segmenter):
-    _mask_generator: SamAutomaticMaskGenerator
-    _predictor: SamPredictor
+    _mask_generator: "SamAutomaticMaskGenerator"
+    _predictor: "SamPredictor"
+    _embeddings: EmbeddingCache
+    _stats: Stats
+    _sam: BackgroundLoad
 
     def __init__(self):
+        self._stats = Stats("segment")
+        # The server binds right away; methods using the models call
+        # self._sam.get() to wait for them.
+        self._sam = BackgroundLoad("sam_vit_h", self._loadSam)
+
+    def _loadSam(self):
+        import torch
+        import wget
+        from segment_anything import (
+            SamAutomaticMaskGenerator,
+            SamPredictor,
+            sam_model_registry,
+        )
+
         model_folder = model_path = Path(__file__).parent.parent / "ignore"
         try:
             os.makedirs(model_folder)
@@ -38,11 +84,12 @@ class SamDetector(label_pb2_grpc.Segmenter):
         sam = sam_model_registry["default"](checkpoint=str(model_path))
         if torch.cuda.is_available():
             sam.to(device="cuda")
-            flush_print('SAM uses cuda.')
+            flush_print("SAM uses cuda.")
         else:
-            flush_print('SAM uses cpu.')
+            flush_print("SAM uses cpu.")
         self._mask_generator = SamAutomaticMaskGenerator(sam)
         self._predictor = SamPredictor(sam)
+        self._embeddings = EmbeddingCache(self._predictor)
 
     def _generate_overlay(
         self,
@@ -59,60 +106,263 @@ class SamDetector(label_pb2_grpc.Segmenter):
         return overlay
 
     def detect_all(self, image: np.ndarray) -> np.ndarray:
+        self._sam.get()
         masks = self._mask_generator.generate(image)
-        return self._generate_overlay(image, [mask['segmentation'] for mask in masks])
+        return self._generate_overlay(image, [mask["segmentation"] for mask in masks])
 
     def detect_one(self, image: np.ndarray, point: np.ndarray) -> np.ndarray:
-        self._predictor.set_image(image)
-        masks, _, _ = self._predictor.predict(point.reshape(1, 2), [1])
-        masks = [masks[i] for i in range(masks.shape[0])]
-        return self._generate_overlay(image, masks)
+        return self.detect_prompt(image, point.reshape(1, 2), np.array([1]))
+
+    def detect_prompt(
+        self,
+        image: np.ndarray,
+        points: np.ndarray = None,
+        labels: np.ndarray = None,
+        box: np.ndarray = None,
+    ) -> np.ndarray:
+        """Overlay of the best mask for (x, y) points and/or an xyxy box.
+
+        Labels are 1 for foreground and 0 for background points. The image
+        embedding is cached, so only the first prompt on a frame is slow.
+        """
+        mask = self.road_mask_from_prompt(image, points, labels, box)
+        return self._generate_overlay(image, [mask])
+
+    def road_mask_from_prompt(
+        self, image: np.ndarray, points=None, labels=None, box=None
+    ) -> np.ndarray:
+        self._sam.get()
+        with self._embeddings.lock:
+            with self._stats.time("sam_embedding"):
+                self._embeddings.set_image(image)
+            with self._stats.time("sam_predict"):
+                masks, scores, _ = self._predictor.predict(
+                    point_coords=points,
+                    point_labels=labels,
+                    box=box,
+                    multimask_output=True,
+                )
+        return masks[np.argmax(scores)]
+
+    def road_mask_from_all(self, image: np.ndarray, point: np.ndarray) -> np.ndarray:
+        """The pixels detect_one_from_all colors, as a boolean mask."""
+        self._sam.get()
+        with self._stats.time("sam_generate"):
+            masks = self._mask_generator.generate(image)
+        r, c = point.astype(int)
+        positive = np.zeros(image.shape[:2], dtype=bool)
+        negative = np.zeros(image.shape[:2], dtype=bool)
+        for mask in masks:
+            segmentation = mask["segmentation"]
+            if segmentation[r][c]:
+                positive |= segmentation
+            else:
+                negative |= segmentation
+        return positive & ~negative
+
+    def propagate(
+        self,
+        image: np.ndarray,
+        previous: np.ndarray,
+        min_iou: float = MIN_IOU,
+        max_area_change: float = MAX_AREA_CHANGE,
+    ):
+        """Segment the road of a frame, prompted by the previous frame's mask.
+
+        Returns (mask, iou with previous, whether the automatic mask generator
+        had to run). It runs for the first frame, an empty previous mask, or
+        when the propagated mask drifted too far.
+        """
+        row, col = np.multiply(image.shape[0:2], [BOTTOM_RATIO, 0.5])
+        if previous is None or not previous.any():
+            return self.road_mask_from_all(image, np.array([row, col])), 0.0, True
+        prompts = prompts_from_mask(previous, np.array([col, row]))
+        mask = self.road_mask_from_prompt(image, *prompts)
+        iou = mask_iou(mask, previous)
+        previous_area = np.count_nonzero(previous)
+        area_change = abs(np.count_nonzero(mask) - previous_area) / previous_area
+        if iou >= min_iou and area_change <= max_area_change:
+            return mask, iou, False
+        self._stats.count("sam_regenerations")
+        mask = self.road_mask_from_all(image, np.array([row, col]))
+        return mask, mask_iou(mask, previous), True
 
     def detect_one_from_all(self, image: np.ndarray, point: np.ndarray) -> np.ndarray:
-        masks = self._mask_generator.generate(image)
-        masks = [mask['segmentation'] for mask in masks]
+        self._sam.get()
+        with self._stats.time("sam_generate"):
+            masks = self._mask_generator.generate(image)
+        masks = [mask["segmentation"] for mask in masks]
         r, c = point.astype(int)
         positive_masks = [mask for mask in masks if mask[r][c]]
         negative_masks = [mask for mask in masks if not mask[r][c]]
         return self._generate_overlay(image, positive_masks, negative_masks)
 
-    def detect_and_save(self, image: np.ndarray, output_path: str) -> None:
+    def detect_and_save(
+        self,
+        image: np.ndarray,
+        output_path: str,
+        points: np.ndarray = None,
+        labels: np.ndarray = None,
+        box: np.ndarray = None,
+        automatic: bool = False,
+    ) -> None:
+        """Segment the road and save the overlay.
+
+        Without prompts, the bottom center point is the only foreground point.
+        The automatic mask generator runs its full point grid (dozens of
+        decoder passes) and is only used if asked for.
+        """
         logging.info("Segmenting...")
-        point = np.multiply(image.shape[0:2], [BOTTOM_RATIO, 0.5])
-        mask = self.detect_one_from_all(image, point)
-        cv2.imwrite(output_path, mask)
+        row, col = np.multiply(image.shape[0:2], [BOTTOM_RATIO, 0.5])
+        if automatic:
+            mask = self.detect_one_from_all(image, np.array([row, col]))
+        else:
+            if points is None and box is None:
+                points, labels = np.array([[col, row]]), np.array([1])
+            mask = self.detect_prompt(image, points, labels, box)
+        with self._stats.time("write_png"):
+            cv2.imwrite(output_path, mask)
         logging.info("Done.")
 
     def Segment(self, request: label_pb2.SegmentRequest, context):
         try:
-            flush_print('Received segment request.')
-            image: np.ndarray
-            if request.video_path:
+            flush_print("Received segment request.")
+            with self._stats.in_flight(), self._stats.time("segment"):
+                self._segment(request)
+            flush_print("Finished segment request.")
+            return label_pb2.Empty()
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def SegmentVideoRange(self, request: label_pb2.SegmentRangeRequest, context):
+        try:
+            begin, end = request.begin_frame, request.end_frame
+            output_path = request.output_path or (
+                f"{request.video_path}.{begin}_{end}.masks.jsonl"
+            )
+            flush_print(f"Segmenting {request.video_path} frames [{begin}, {end})")
+            with self._stats.in_flight(), open(output_path, "w") as f:
+                previous = None
+                for frame_index in range(begin, end):
+                    if not context.is_active():
+                        flush_print(f"Client cancelled at frame {frame_index}")
+                        return
+                    with self._stats.time("read_video"):
+                        bgr = read_video_bgr(request.video_path, frame_index)
+                    if bgr is None:
+                        flush_print(f"Video ended at frame {frame_index}")
+                        break
+                    self._stats.count("frames")
+                    image = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+                    with self._stats.time("propagate"):
+                        mask, iou, regenerated = self.propagate(
+                            image,
+                            previous,
+                            request.min_iou or MIN_IOU,
+                            request.max_area_change or MAX_AREA_CHANGE,
+                        )
+                    # Flush per frame so a cancelled range keeps its masks.
+                    f.write(rle_line(frame_index, mask, regenerated))
+                    f.flush()
+                    previous = mask
+                    yield label_pb2.SegmentResult(
+                        frame_index=frame_index,
+                        area_ratio=np.count_nonzero(mask) / mask.size,
+                        iou=iou,
+                        regenerated=regenerated,
+                        output_path=output_path,
+                    )
+            flush_print(f"Decoder stats: {decoder_stats()}")
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def _segment(self, request: label_pb2.SegmentRequest):
+        image: np.ndarray
+        self._stats.count("frames")
+        if request.video_path:
+            with self._stats.time("read_video"):
                 bgr = read_video_bgr(request.video_path, request.frame_index)
-                image = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-            else:
-                # Read an image using cv2 into RGB
+            image = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        else:
+            # Read an image using cv2 into RGB
+            with self._stats.time("read_image"):
                 image = cv2.imread(request.image_path)
-                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            self.detect_and_save(image, request.output_path)
-            flush_print('Finished segment request.')
-            return label_pb2.Empty()
+            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+        self.detect_and_save(
+            image, request.output_path, *self._prompts(request), request.automatic
+        )
+
+    def _prompts(self, request: label_pb2.SegmentRequest):
+        """(points, labels, box) of the request, None where not given."""
+        points = [(p.x, p.y, 1) for p in request.points]
+        points += [(p.x, p.y, 0) for p in request.negative_points]
+        prompts = np.array(points).reshape(-1, 3)
+        box = None
+        if request.HasField("box"):
+            b = request.box
+            box = np.array([b.l, b.t, b.r, b.b])
+        if not points:
+            return None, None, box
+        return prompts[:, :2], prompts[:, 2].astype(int), box
+
+    def Health(self, request: label_pb2.Empty, context):
+        try:
+            return health([self._sam])
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def WaitReady(self, request: label_pb2.WaitReadyRequest, context):
+        try:
+            return health([self._sam], request.timeout_seconds)
         except Exception as e:
-            print(f'Error: {e}')
+            print(f"Error: {e}")
             flush_print(traceback.format_exc())
             raise
 
+    def GetStats(self, request: label_pb2.Empty, context):
+        try:
+            return self._stats.to_proto(*self._componentStats())
+        except Exception as e:
+            print(f"Error: {e}")
+            flush_print(traceback.format_exc())
+            raise
+
+    def dump_stats_periodically(self, path: str, interval_s: float):
+        self._stats.dump_periodically(path, interval_s, self._componentStats)
+
+    def _componentStats(self):
+        counters = {f"decoder_{k}": v for k, v in decoder_stats().items()}
+        if not self._sam.ready():
+            return counters, {}
+        embeddings = self._embeddings.stats()
+        for k in ["hits", "misses", "evictions"]:
+            counters[f"sam_embedding_{k}"] = embeddings[k]
+        return counters, {"sam_embeddings": embeddings["embeddings"]}
 
 
-def main():
+@click.command()
+@click.option(
+    "--stats_path",
+    default=None,
+    help="Periodically write GetStats in the Prometheus text format to this file.",
+)
+@click.option("--stats_interval", default=10.0, help="Seconds between stats dumps.")
+def main(stats_path: str, stats_interval: float):
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s - %(message)s",  # Include timestamp in log format
         datefmt="%H:%M:%S",  # Customize timestamp format
     )
-    logging.info("Initializing SamDetector...")
+    # SAM loads (and may download) in the background; see WaitReady.
     detector = SamDetector()
-    logging.info("SamDetector initialized.")
+    if stats_path:
+        detector.dump_stats_periodically(stats_path, stats_interval)
 
     name: str = Path(__file__).stem
     pid = os.getpid()
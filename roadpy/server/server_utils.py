@@ -1,14 +1,106 @@
+from collections import OrderedDict, deque
 import sys
+import threading
 
 import cv2
 
+
 def flush_print(msg: str):
     print(msg)
     sys.stdout.flush()
 
+
+class VideoDecoder:
+    """Keeps a video open so sequential frame reads don't need to seek.
+
+    The last few decoded frames are kept in a ring buffer so stepping back and
+    forth by a frame or two (as the labeler does) is free.
+    """
+
+    RING_SIZE = 4
+
+    def __init__(self, video_path: str, count):
+        self._video_path = video_path
+        self._cap = None
+        self._next_index = 0  # index of the frame that cap.read() returns next
+        self._ring = deque(maxlen=self.RING_SIZE)  # (frame_index, bgr)
+        self._count = count  # count(name) bumps a pool-wide counter
+        self.lock = threading.Lock()
+
+    def read(self, frame_index: int):
+        for index, bgr in self._ring:
+            if index == frame_index:
+                self._count("hits")
+                return bgr
+        if self._cap is None:
+            self._count("opens")
+            self._cap = cv2.VideoCapture(self._video_path)
+            self._next_index = 0
+        if frame_index != self._next_index:
+            self._count("seeks")
+            self._cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+        ok, bgr = self._cap.read()
+        self._count("decodes")
+        if not ok:
+            # Force a seek on the next read since the position is unknown.
+            self._next_index = -1
+            return None
+        self._next_index = frame_index + 1
+        self._ring.append((frame_index, bgr))
+        return bgr
+
+    def release(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+
+class DecoderPool:
+    """Thread-safe LRU pool of VideoDecoder keyed by video path."""
+
+    def __init__(self, max_videos: int = 4):
+        self._max_videos = max_videos
+        self._decoders: OrderedDict[str, VideoDecoder] = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {"hits": 0, "seeks": 0, "decodes": 0, "opens": 0}
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def read(self, video_path: str, frame_index: int):
+        evicted = []
+        with self._lock:
+            decoder = self._decoders.get(video_path)
+            if decoder is None:
+                decoder = VideoDecoder(video_path, self._count)
+                self._decoders[video_path] = decoder
+                while len(self._decoders) > self._max_videos:
+                    evicted.append(self._decoders.popitem(last=False)[1])
+            else:
+                self._decoders.move_to_end(video_path)
+        # An evicted decoder may still be read by another thread, which simply
+        # reopens it. Release outside the pool lock so other videos don't wait.
+        for old in evicted:
+            with old.lock:
+                old.release()
+        with decoder.lock:
+            bgr = decoder.read(frame_index)
+        # Callers may draw on the frame, so don't hand out the cached copy.
+        return None if bgr is None else bgr.copy()
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+_decoder_pool = DecoderPool()
+
+
+def decoder_stats() -> dict:
+    return _decoder_pool.stats()
+
+
 def read_video_bgr(video_path: str, frame_index: int):
-    cap = cv2.VideoCapture(video_path)
-    cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
-    _, bgr = cap.read()
-    cap.release()
-    return bgr
+    return _decoder_pool.read(video_path, frame_index)
@@ -0,0 +1,153 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import os
+import threading
+import time
+
+from proto import label_pb2
+
+# Upper bounds in seconds; the last bucket catches everything slower.
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def percentile(self, q: float) -> float:
+        """Upper bound (seconds) of the bucket holding the q-th quantile."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, n in zip(BUCKETS, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Stats:
+    """Thread-safe stage latency histograms, counters and gauges of a server.
+
+    Recording is a dict lookup and a bisect under one lock, so it's cheap
+    enough to wrap every stage of every request.
+    """
+
+    def __init__(self, server: str):
+        self.server = server
+        self._lock = threading.Lock()
+        self._stages: dict[str, Histogram] = {}
+        self._counters: dict[str, int] = {}
+        self._gauges: dict[str, float] = {}
+        self._start = time.monotonic()
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._stages.get(stage)
+            if histogram is None:
+                histogram = self._stages[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set_gauge(self, name: str, value: float):
+        with self._lock:
+            self._gauges[name] = value
+
+    def add_gauge(self, name: str, delta: float):
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + delta
+
+    @contextmanager
+    def in_flight(self):
+        """Track the number of concurrent requests as the in_flight gauge."""
+        self.add_gauge("in_flight", 1)
+        try:
+            yield
+        finally:
+            self.add_gauge("in_flight", -1)
+
+    def to_proto(self, counters: dict = None, gauges: dict = None):
+        """Snapshot as ServerStats. Extra counters and gauges are merged in."""
+        with self._lock:
+            stats = label_pb2.ServerStats(
+                server=self.server,
+                uptime_seconds=time.monotonic() - self._start,
+                bucket_bounds=BUCKETS,
+            )
+            for stage, h in sorted(self._stages.items()):
+                stats.stages.append(
+                    label_pb2.StageStats(
+                        stage=stage,
+                        count=h.count,
+                        total_seconds=h.total,
+                        bucket_counts=h.counts,
+                        p50_ms=h.percentile(0.5) * 1000,
+                        p90_ms=h.percentile(0.9) * 1000,
+                        p99_ms=h.percentile(0.99) * 1000,
+                    )
+                )
+            stats.counters.update(self._counters)
+            stats.gauges.update(self._gauges)
+        stats.counters.update(counters or {})
+        stats.gauges.update(gauges or {})
+        return stats
+
+    def to_prometheus(self, counters: dict = None, gauges: dict = None) -> str:
+        """The ServerStats in the Prometheus text exposition format."""
+        stats = self.to_proto(counters, gauges)
+        server = f'server="{stats.server}"'
+        lines = ["# TYPE roadpy_stage_seconds histogram"]
+        for stage in stats.stages:
+            labels = f'{server},stage="{stage.stage}"'
+            cumulative = 0
+            for bound, n in zip(list(BUCKETS) + ["+Inf"], stage.bucket_counts):
+                cumulative += n
+                bucket = f'{labels},le="{bound}"'
+                lines.append(f"roadpy_stage_seconds_bucket{{{bucket}}} {cumulative}")
+            total = stage.total_seconds
+            lines.append(f"roadpy_stage_seconds_sum{{{labels}}} {total}")
+            lines.append(f"roadpy_stage_seconds_count{{{labels}}} {stage.count}")
+        for name, value in sorted(stats.counters.items()):
+            lines.append(f"# TYPE roadpy_{name}_total counter")
+            lines.append(f"roadpy_{name}_total{{{server}}} {value}")
+        gauges = dict(stats.gauges, uptime_seconds=stats.uptime_seconds)
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE roadpy_{name} gauge")
+            lines.append(f"roadpy_{name}{{{server}}} {value}")
+        return "\n".join(lines) + "\n"
+
+    def dump_periodically(self, path: str, interval_s: float, extra=None):
+        """Rewrite a Prometheus text file every interval_s seconds.
+
+        `extra` returns the (counters, gauges) owned by other components, e.g.,
+        cache stats. The file is replaced atomically for scrapers like
+        node_exporter's textfile collector.
+        """
+
+        def loop():
+            while True:
+                time.sleep(interval_s)
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(self.to_prometheus(*(extra() if extra else ())))
+                os.replace(tmp_path, path)
+
+        threading.Thread(target=loop, daemon=True).start()
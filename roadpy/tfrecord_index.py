@@ -0,0 +1,86 @@
+import glob
+import json
+import os
+import struct
+from typing import List
+
+import numpy as np
+
+from tfrecord_utils import is_test_path
+
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+import tensorflow as tf  # noqa: E402
+
+# A TFRecord is: uint64 length, uint32 length crc, data, uint32 data crc.
+HEADER_SIZE = 12
+FOOTER_SIZE = 4
+
+
+def index_path(shard_path: str) -> str:
+    return shard_path + ".index"
+
+
+def write_index(shard_path: str, lengths: List[int], paths: List[str]):
+    """Write the offsets of records written in order with these lengths."""
+    sizes = [HEADER_SIZE + n + FOOTER_SIZE for n in lengths]
+    offsets = np.cumsum([0] + sizes)[:-1]
+    index = {"offsets": offsets.tolist(), "lengths": list(lengths), "paths": paths}
+    with open(index_path(shard_path), "w") as f:
+        json.dump(index, f)
+
+
+def build_index(shard_path: str):
+    """Scan a shard that was written without an index."""
+    lengths, paths = [], []
+    with open(shard_path, "rb") as f:
+        while header := f.read(HEADER_SIZE):
+            (length,) = struct.unpack("<Q", header[:8])
+            example = tf.train.Example.FromString(f.read(length))
+            f.seek(FOOTER_SIZE, os.SEEK_CUR)
+            lengths.append(length)
+            path = example.features.feature["debug_image_path"].bytes_list.value
+            paths.append(path[0].decode() if path else "")
+    write_index(shard_path, lengths, paths)
+
+
+class RecordReader:
+    """Random access to the records of TFRecord shards through their indices."""
+
+    def __init__(self, pattern: str):
+        self._shards = sorted(glob.glob(pattern))
+        self._files = {}
+        shard_ids, offsets, lengths, self.paths = [], [], [], []
+        for shard_id, shard in enumerate(self._shards):
+            if not os.path.exists(index_path(shard)):
+                print(f"Indexing {shard}")
+                build_index(shard)
+            with open(index_path(shard)) as f:
+                index = json.load(f)
+            shard_ids += [shard_id] * len(index["offsets"])
+            offsets += index["offsets"]
+            lengths += index["lengths"]
+            self.paths += index["paths"]
+        self._shard_ids = np.array(shard_ids, dtype=np.int64)
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self._lengths = np.array(lengths, dtype=np.int64)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def read(self, i: int) -> bytes:
+        shard_id = int(self._shard_ids[i])
+        if shard_id not in self._files:
+            self._files[shard_id] = open(self._shards[shard_id], "rb")
+        f = self._files[shard_id]
+        f.seek(int(self._offsets[i]) + HEADER_SIZE)
+        return f.read(int(self._lengths[i]))
+
+    def example(self, i: int) -> tf.train.Example:
+        return tf.train.Example.FromString(self.read(i))
+
+    def split(self):
+        """Return (test indices, train indices), the same as split_dataset."""
+        if not self.paths:
+            return np.array([], np.int64), np.array([], np.int64)
+        is_test = is_test_path(tf.constant(self.paths)).numpy()
+        return np.flatnonzero(is_test), np.flatnonzero(~is_test)
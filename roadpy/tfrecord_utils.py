@@ -3,9 +3,9 @@ import os
 import cv2
 
 os.environ["KERAS_BACKEND"] = "jax"
-import keras  # noqa: E402
-import tensorflow as tf  # noqa: E402
 
+# TensorFlow is imported by the functions that use it, so the servers, which
+# only need resize_image and draw_prediction, don't spend seconds on it.
 
 LABEL_SIZE = 9
 IMAGE_W = 320  # 640
@@ -14,24 +14,56 @@ IMAGE_H = 240  # 360
 RESULT_JSON_PATH = "../data/label_result.json"
 TFRECORD_PATH = "../data/labeled_bgr.tfrecord"
 
+TEST_PERCENT = 5
+
+
+def is_test_path(debug_image_path):
+    """Whether a record belongs to the test split, by a hash of its path.
+
+    Works on a string tensor of any shape and returns a bool tensor.
+    """
+    import tensorflow as tf
+
+    return tf.strings.to_hash_bucket_fast(debug_image_path, 100) < TEST_PERCENT
+
+
+def is_test_record(record):
+    import tensorflow as tf
+
+    features = {
+        "debug_image_path": tf.io.FixedLenFeature([], tf.string, default_value="")
+    }
+    path = tf.io.parse_single_example(record, features)["debug_image_path"]
+    return is_test_path(path)
+
+
+def split_records(records):
+    """
+    Splits serialized TFRecord examples into (test, train) datasets.
+
+    The split only depends on each record's debug_image_path, so it doesn't
+    change with the order of shards or records.
+    """
+    import tensorflow as tf
+
+    test_records = records.filter(is_test_record)
+    train_records = records.filter(lambda r: tf.logical_not(is_test_record(r)))
+    return test_records, train_records
+
 
 def split_dataset(dataset):
     """
     Splits the given dataset into test and train datasets.
 
     Args:
-        dataset: The input dataset to be split.
+        dataset: The input dataset of serialized examples to be split.
 
     Returns:
         A tuple containing the test dataset and train dataset.
     """
-    shuffled = dataset.shuffle(1024, seed=0, reshuffle_each_iteration=False)
-    test_size = 500
-    test_dataset = shuffled.take(test_size).batch(1)
-    train_dataset = (
-        shuffled.skip(test_size).shuffle(1024, reshuffle_each_iteration=True).batch(32)
-    )
-    return test_dataset, train_dataset
+    test_records, train_records = split_records(dataset)
+    train_records = train_records.shuffle(1024, reshuffle_each_iteration=True)
+    return test_records.batch(1), train_records.batch(32)
 
 
 def resize_image(image, width: int = IMAGE_W, height: int = IMAGE_H):
@@ -63,6 +95,8 @@ def resize_image(image, width: int = IMAGE_W, height: int = IMAGE_H):
 
 
 def bgr_to_rgb(image):
+    import tensorflow as tf
+
     image = tf.reverse(image, axis=[-1])
     return image
 
@@ -117,12 +151,11 @@ def draw_label(image_bgr, label, point_color=(0, 0, 255), line_color=(255, 0, 0)
         )
 
 
-# Return a new bgr image with the prediction lines
-def draw_prediction(model: keras.Model, image_bgr):
+# Return a new bgr image with the prediction lines. The engine is an
+# inference.InferenceBackend such as KerasBackend (or anything with predict_bgr).
+def draw_prediction(engine, image_bgr):
     resized = resize_image(image_bgr, IMAGE_W, IMAGE_H)
-    input = bgr_to_rgb(resized)
-    input = tf.expand_dims(input, 0)
-    prediction = model.predict(input)
+    prediction = engine.predict_bgr([resized])
     print(f"prediction={prediction}")
     result = resized.copy()
     draw_label(result, prediction[0], (0, 255, 255), (0, 255, 0))
@@ -1,29 +1,40 @@
 import os
-import sys
 import glob
+import time
+import click
 import cv2
+import numpy as np
+
+from raw_dataset import RawDataset
 
 from tfrecord_utils import (
     LABEL_SIZE,
     IMAGE_W,
     IMAGE_H,
-    TFRECORD_PATH,
     bgr_to_rgb,
-    split_dataset,
+    split_records,
 )
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 os.environ["KERAS_BACKEND"] = "jax"
 
+# JAX reads XLA_FLAGS only once, so the host devices for --devices have to be
+# set up before keras is imported.
+DEVICES = int(os.environ.get("TRAIN_DEVICES", 1))
+if DEVICES > 1:
+    _flag = f"--xla_force_host_platform_device_count={DEVICES}"
+    os.environ["XLA_FLAGS"] = f"{os.environ.get('XLA_FLAGS', '')} {_flag}".strip()
+
 # TensorFlow needs to be imported before keras to avoid some errors.
 import tensorflow as tf  # noqa: E402
 import keras  # noqa: E402
 
 IGNORE_LEFT = True
+TFRECORD_GLOB = "../data/*.tfrecord"
+AUTOTUNE = tf.data.AUTOTUNE
 
 print(f"keras backend: {keras.backend.backend()}")
 
-dataset = tf.data.TFRecordDataset(TFRECORD_PATH)
 
 # The decoded png has a BGR format.
 def decode_png(example):
@@ -33,7 +44,9 @@ def decode_png(example):
     }
     example = tf.io.parse_single_example(example, features)
     image = tf.image.decode_png(example["image"], channels=3)
-    image = tf.image.resize(image, [IMAGE_H, IMAGE_W])
+    # make_tfrecord.py already resized images, so keep them uint8 (resizing
+    # would convert to float32 and back for nothing).
+    image = tf.ensure_shape(image, [IMAGE_H, IMAGE_W, 3])
     return image, example["label"]
 
 
@@ -43,11 +56,63 @@ def bgr_to_input(image, label: tf.Tensor):
     return bgr_to_rgb(image), tf.multiply(sliced, [1, 1, 0 if IGNORE_LEFT else 1, 1])
 
 
-def load_dataset_rgb_int8(check: bool = False):
-    dataset = tf.data.TFRecordDataset(glob.glob("../data/*.tfrecord"))
-    decoded = dataset.map(decode_png)
-    rgb_float_dataset = decoded.map(bgr_to_input)
+def decode_to_input(example):
+    return bgr_to_input(*decode_png(example))
+
+
+def _decode_split(records, cache: str, name: str, count: int = 0):
+    if count:
+        # Take before caching so the file cache is complete after one pass.
+        records = records.take(count)
+    dataset = records.map(decode_to_input, num_parallel_calls=AUTOTUNE)
+    if cache == "memory":
+        return dataset.cache()
+    elif cache:
+        return dataset.cache(f"{cache}_{name}")
+    return dataset
+
+
+def _read_shards(paths, shuffle: bool):
+    """Records of the shards, interleaved in a fixed order unless shuffled."""
+    files = tf.data.Dataset.from_tensor_slices(paths)
+    if shuffle:
+        files = files.shuffle(len(paths))
+    return files.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=8,
+        num_parallel_calls=AUTOTUNE,
+        deterministic=not shuffle,
+    )
+
+
+def load_dataset_rgb_int8(
+    check: bool = False,
+    pattern: str = TFRECORD_GLOB,
+    cache: str = None,
+    val_count: int = 0,
+):
+    """
+    Loads the TFRecord shards matching `pattern` as unbatched (test, train)
+    datasets of (rgb uint8, label) pairs.
+
+    Shards are read and decoded in parallel. split_records splits by a hash
+    of each record's path, so the order doesn't change the split. Only the
+    train records are shuffled, which keeps the first val_count test examples
+    the same every epoch.
+
+    Args:
+        cache: None for no cache, "memory" to keep decoded images in RAM, or a
+            file path prefix to cache them on disk.
+        val_count: Keep at most this many test examples (0 for all).
+    """
+    paths = sorted(glob.glob(pattern))
+    dataset = _read_shards(paths, shuffle=False)
+    test_records, _ = split_records(dataset)
+    _, train_records = split_records(_read_shards(paths, shuffle=True))
+    test_dataset = _decode_split(test_records, cache, "test", val_count)
+    train_dataset = _decode_split(train_records, cache, "train")
     if check:
+        decoded = dataset.map(decode_png)
         for record in decoded.take(1):
             image, label = record
             print(f"label={label}")
@@ -55,13 +120,159 @@ def load_dataset_rgb_int8(check: bool = False):
             print(f"image.dtype={image.dtype}")
             cv2.imshow("image", image.numpy())
             cv2.waitKey(0)
-        for record in rgb_float_dataset.take(1):
+        for record in train_dataset.take(1):
             image, label = record
             print(f"label={label}")
             print(f"image.shape={image.shape}")
             print(f"image.dtype={image.dtype}")
             print(f"image[100][100]={image[100][100]}")
-    return rgb_float_dataset
+    return test_dataset, train_dataset
+
+
+def probe_throughput(dataset):
+    """Iterate over all batches of an epoch and report examples/sec."""
+    if not isinstance(dataset, tf.data.Dataset):
+        dataset = (dataset[i] for i in range(len(dataset)))  # RawBatches
+    examples, start = 0, time.perf_counter()
+    for images, _ in dataset:
+        examples += int(images.shape[0])
+    seconds = time.perf_counter() - start
+    print(f"{examples} examples in {seconds:.2f}s: {examples / seconds:.1f} ex/s")
+
+
+class RawBatches(keras.utils.PyDataset):
+    """Feeds (rgb uint8, label) batches of the given rows to keras."""
+
+    def __init__(
+        self,
+        raw: RawDataset,
+        rows: np.ndarray,
+        labels: np.ndarray,
+        batch_size: int = 32,
+        shuffle: bool = True,
+        drop_remainder: bool = False,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self._raw = raw
+        self._rows = np.array(rows)
+        self._labels = labels  # already transformed labels of all raw rows
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._drop_remainder = drop_remainder
+        self.on_epoch_end()
+
+    def __len__(self):
+        if self._drop_remainder:
+            return len(self._rows) // self._batch_size
+        return (len(self._rows) + self._batch_size - 1) // self._batch_size
+
+    def __getitem__(self, index: int):
+        start = index * self._batch_size
+        # Sorted rows read the memory map more sequentially.
+        rows = np.sort(self._rows[start : start + self._batch_size])
+        bgr = self._raw.images[rows]
+        return np.ascontiguousarray(bgr[..., ::-1]), self._labels[rows]
+
+    def on_epoch_end(self):
+        if self._shuffle:
+            np.random.shuffle(self._rows)
+
+
+class BatchConfig:
+    def __init__(self, batch_size: int, val_batch_size: int, val_count: int, devices):
+        self.batch_size = batch_size
+        self.val_batch_size = val_batch_size
+        self.val_count = val_count
+        # Every device must get an equal share of each batch.
+        self.drop_remainder = devices > 1
+        if batch_size % devices or val_batch_size % devices:
+            raise ValueError(f"Batch sizes must be multiples of {devices} devices")
+
+
+def load_raw_datasets(raw_dir: str, config: BatchConfig):
+    """Return (test, train) batches of the memory-mapped arrays in raw_dir."""
+    raw = RawDataset(raw_dir)
+    mask = [1, 1, 0 if IGNORE_LEFT else 1, 1]
+    labels = (raw.labels[:, :4] * mask).astype(np.float32)
+    test_rows, train_rows = raw.split()
+    if config.val_count:
+        test_rows = test_rows[: config.val_count]
+    test_dataset = RawBatches(
+        raw,
+        test_rows,
+        labels,
+        batch_size=config.val_batch_size,
+        shuffle=False,
+        drop_remainder=config.drop_remainder,
+    )
+    train_dataset = RawBatches(
+        raw,
+        train_rows,
+        labels,
+        batch_size=config.batch_size,
+        drop_remainder=config.drop_remainder,
+        workers=4,
+    )
+    return test_dataset, train_dataset
+
+
+def batch_tf_datasets(test_dataset, train_dataset, config: BatchConfig):
+    test_dataset = test_dataset.batch(
+        config.val_batch_size, drop_remainder=config.drop_remainder
+    )
+    train_dataset = train_dataset.shuffle(1024, reshuffle_each_iteration=True)
+    train_dataset = train_dataset.batch(
+        config.batch_size, drop_remainder=config.drop_remainder
+    )
+    return test_dataset.prefetch(AUTOTUNE), train_dataset.prefetch(AUTOTUNE)
+
+
+class StepTimer(keras.callbacks.Callback):
+    """Reports the mean train step time and examples/sec of each epoch."""
+
+    def __init__(self, batch_size: int):
+        super().__init__()
+        self._batch_size = batch_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._steps, self._seconds = 0, 0.0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps += 1
+        self._seconds += time.perf_counter() - self._start
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self._steps == 0:
+            return
+        step_ms = 1000 * self._seconds / self._steps
+        throughput = self._steps * self._batch_size / self._seconds
+        print(f"\nEpoch {epoch}: {step_ms:.1f} ms/step, {throughput:.1f} ex/s")
+        if logs is not None:
+            logs["step_ms"] = step_ms
+            logs["examples_per_sec"] = throughput
+
+
+def use_data_parallel(devices: int):
+    """Replicate the model over `devices` CPU devices and split each batch.
+
+    The host devices come from TRAIN_DEVICES, which is read at import time
+    (see DEVICES). Keras syncs the gradients across devices.
+    """
+    device_list = keras.distribution.list_devices("cpu")
+    if len(device_list) < devices:
+        raise click.UsageError(
+            f"Only {len(device_list)} CPU devices. Set TRAIN_DEVICES={devices} "
+            "instead of --devices since XLA_FLAGS must be set before keras loads."
+        )
+    device_list = device_list[:devices]
+    print(f"Data parallel over {len(device_list)} devices")
+    keras.distribution.set_distribution(
+        keras.distribution.DataParallel(devices=device_list)
+    )
 
 
 def make_block(x, channels: int):
@@ -122,15 +333,72 @@ def make_mobilenet_pretrained() -> keras.Model:
     return compile_model(base_model.input, output)
 
 
-dataset = load_dataset_rgb_int8()
+@click.command()
+@click.option(
+    "--cache",
+    type=str,
+    default=None,
+    help='Cache decoded images: "memory" or a file path prefix on disk.',
+)
+@click.option(
+    "--probe",
+    is_flag=True,
+    help="Only measure the input pipeline's throughput.",
+)
+@click.option(
+    "--raw_dir",
+    type=str,
+    default=None,
+    help="Train on arrays from make_tfrecord.py --raw_dir instead of TFRecords.",
+)
+@click.option("--batch_size", default=32, help="Global train batch size.")
+@click.option("--val_batch_size", default=64, help="Validation batch size.")
+@click.option(
+    "--val_count",
+    default=0,
+    help="Validate on at most this many test examples (0 for all).",
+)
+@click.option(
+    "--devices",
+    default=1,
+    envvar="TRAIN_DEVICES",
+    help="Train data-parallel over this many CPU devices (JAX host devices). "
+    "Set TRAIN_DEVICES instead so XLA_FLAGS is set before keras is imported.",
+)
+@click.argument("model_file", required=False)
+def train(
+    cache: str,
+    probe: bool,
+    raw_dir: str,
+    batch_size: int,
+    val_batch_size: int,
+    val_count: int,
+    devices: int,
+    model_file: str,
+):
+    """Train a new model, or evaluate MODEL_FILE if given."""
+    config = BatchConfig(batch_size, val_batch_size, val_count, devices)
+    if devices > 1:
+        use_data_parallel(devices)
+
+    if raw_dir:
+        test_dataset, train_dataset = load_raw_datasets(raw_dir, config)
+    else:
+        test_dataset, train_dataset = batch_tf_datasets(
+            *load_dataset_rgb_int8(cache=cache, val_count=val_count), config
+        )
+
+    if probe:
+        # The cache is only complete after a full pass, so probe two epochs.
+        probe_throughput(train_dataset)
+        probe_throughput(train_dataset)
+        return
 
-# Split the dataset into train and test datasets
-test_dataset, train_dataset = split_dataset(dataset)
+    if model_file:
+        model: keras.Model = keras.models.load_model(model_file)
+        model.evaluate(test_dataset)
+        return
 
-if len(sys.argv) > 1:
-    model: keras.Model = keras.models.load_model(sys.argv[1])
-    model.evaluate(test_dataset)
-else:
     # model: keras.Model = make_compiled_model()
     model: keras.Model = make_mobilenet_pretrained()
     print(model.summary())
@@ -146,5 +414,9 @@ else:
         train_dataset,
         epochs=2000,
         validation_data=test_dataset,
-        callbacks=[cp_callback, board_callback],
+        callbacks=[StepTimer(batch_size), cp_callback, board_callback],
     )
+
+
+if __name__ == "__main__":
+    train()